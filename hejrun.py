@@ -87,6 +87,8 @@ def parse_arguments():
                       help = "Use gfal for file transfer and storage rather than the LFN")
     parser.add_option("--gfal_location", default="",
                       help = "Provide a specific location for gfal executables [intended for cvmfs locations]. Default is the environment gfal.")
+    parser.add_option("--protocols", default=",".join(PROTOCOLS),
+                      help = "Comma separated gfal protocols, in the order they should be tried")
 
     # LHAPDF options
     parser.add_option("--use_cvmfs_lhapdf", action = "store_true", default = True)
@@ -109,6 +111,7 @@ def parse_arguments():
     parser.add_option("--pedantic", help = "Enable various checks", action = "store_true", default = False)
 
     (options, positional) = parser.parse_args()
+    options.protocols = [i for i in options.protocols.split(",") if i]
 
 
     if options.use_gfal.lower() == "true":
@@ -216,7 +219,7 @@ def copy_to_grid(local_file, grid_file, args, maxrange = 10):
 def gfal_copy(infile, outfile, args, maxrange=MAX_COPY_TRIES):
     print_flush("Copying {0} to {1}".format(infile, outfile))
     protoc = args.gfaldir.split(":")[0]
-    for protocol in PROTOCOLS: # cycle through available protocols until one works.
+    for protocol in list(args.protocols): # cycle through available protocols until one works.
         infile_tmp = infile.replace(protoc, protocol)
         outfile_tmp = outfile.replace(protoc, protocol)
         print_flush("Attempting Protocol {0}".format(protocol))
@@ -227,6 +230,9 @@ def gfal_copy(infile, outfile, args, maxrange=MAX_COPY_TRIES):
                 print_flush(cmd)
             retval = syscall(cmd)
             if retval == 0:
+                # Try the protocol that works first for the rest of the job
+                args.protocols.remove(protocol)
+                args.protocols.insert(0, protocol)
                 return retval
             # if copying to the grid and it has failed, remove before trying again
             if retval != 0 and "file" not in outfile and not args.Sockets:
@@ -2,6 +2,8 @@
 import os
 import sys
 import datetime
+import hashlib
+import shutil
 import socket
 from optparse import OptionParser
 from getpass import getuser
@@ -40,6 +42,11 @@ def output_name(runcard, rname, seed):
     # This function must always be the same as the one in Backend.py
     out = "output{0}-{1}-{2}.tar.gz".format(runcard, rname, seed)
     return out
+
+
+def shared_executable_name(executable, digest):
+    # This function must always be the same as the one in program_interface.py
+    return "{0}-{1}.tar.gz".format(executable, digest)
 ####### END FILE NAME HELPERS #######     
 
 #### Override os.system with custom version that auto sets debug level on failure
@@ -89,6 +96,13 @@ def setup_sockets(args, nnlojet_command, bring_status):
         print_flush("Timeout'd by socket server")
         sys.exit(0)
     print_flush("Connected to socket server")
+    if "-relay" in socket_config:
+        # Talk to the relay socket server assigned to this job from now on
+        socket_config, relay = socket_config.split("-relay")
+        host, port = relay.strip().rsplit(":", 1)
+        socket_config = socket_config.strip()
+        args.Host, args.port = host, port
+        print_flush("Using relay socket server {0}:{1}".format(host, port))
     nnlojet_command += " -port {0} -host {1} {2}".format(port, host,  socket_config)
     return nnlojet_command, socket_config
 
@@ -171,6 +185,8 @@ def parse_arguments():
                       help = "Use gfal for file transfer and storage rather than the LFN")
     parser.add_option("--gfal_location", default="", 
                       help = "Provide a specific location for gfal executables [intended for cvmfs locations]. Default is the environment gfal.")
+    parser.add_option("--protocols", default=",".join(PROTOCOLS),
+                      help = "Comma separated gfal protocols, in the order they should be tried")
 
     # LHAPDF options
     parser.add_option("--lhapdf_grid", help = "absolute value of lhapdf location or relative to gfaldir", 
@@ -194,6 +210,7 @@ def parse_arguments():
     parser.add_option("--events", default="0")
 
     (options, positional) = parser.parse_args()
+    options.protocols = [i for i in options.protocols.split(",") if i]
 
     # Post-parsing setup/checks
 
@@ -252,11 +269,11 @@ def tar_this(tarfile, sourcefiles):
 ####### SOCKET HELPERS #######
 def socket_sync_str(host, port, handshake = "greetings"):
     # Blocking call, it will receive a str of the form
-    # -sockets {0} -ns {1}
+    # -sockets {0} -ns {1} [-relay {host}:{port}]
     sid = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sid.connect((host, int(port)))
     sid.send(handshake)
-    return sid.recv(32)
+    return sid.recv(256)
 ####### END SOCKET HELPERS #######
 
 
@@ -267,6 +284,7 @@ def bring_files(args):
         print_flush("Using own version of LHAPDF")
         bring_status += bring_lhapdf(args.lhapdf_grid, debug_level)
     bring_status += bring_nnlojet(args.input_folder, args.runcard, args.runname, debug_level)
+    bring_status += bring_executable(args.input_folder, args.executable, debug_level)
     os.system("chmod +x {0}".format(args.executable))
     if bring_status != 0:
         print_flush("Not able to bring data from storage. Exiting now.")
@@ -293,6 +311,55 @@ def bring_nnlojet(input_grid, runcard, runname, debug):
     return stat
 
 
+def file_sha256(filename):
+    sha = hashlib.sha256()
+    infile = open(filename, "rb")
+    try:
+        chunk = infile.read(1<<20)
+        while chunk:
+            sha.update(chunk)
+            chunk = infile.read(1<<20)
+    finally:
+        infile.close()
+    return sha.hexdigest()
+
+
+def bring_executable(input_grid, executable, debug):
+    # The input tarball carries either the executable or its sha256, in which
+    # case the executable is shared by all runcards and cached in the scratch dir
+    pointer = "{0}.sha256".format(executable)
+    if not os.path.isfile(pointer):
+        return 0
+    digest = open(pointer).read().strip()
+    cache_dir = os.path.join(os.environ.get("TMPDIR", "/tmp"), "pyHepGrid_executables")
+    cached = os.path.join(cache_dir, digest)
+    if os.path.isfile(cached) and file_sha256(cached) == digest:
+        print_flush("Using cached executable {0}".format(cached))
+        shutil.copy(cached, executable)
+        return 0
+
+    tmp_tar = "executable.tar.gz"
+    input_name = "{0}/{1}".format(input_grid, shared_executable_name(executable, digest))
+    stat = copy_from_grid(input_name, tmp_tar, args)
+    stat += untar_file(tmp_tar, debug)
+    stat += os.system("rm {0}".format(tmp_tar))
+    if stat != 0:
+        return stat
+    if file_sha256(executable) != digest:
+        print_flush("Executable does not match its sha256 {0}".format(digest))
+        return 1
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Copy then rename so that other jobs on the node never see half a file
+        tmp_cached = "{0}.{1}".format(cached, os.getpid())
+        shutil.copy(executable, tmp_cached)
+        os.rename(tmp_cached, cached)
+    except (IOError, OSError) as e:
+        print_flush("Could not cache executable: {0}".format(e))
+    return 0
+
+
 def store_output(args, socketed=False, socket_config=""):
     # Copy stuff to grid storage, remove executable and lhapdf folder
     syscall("rm core*") # Core files can be upwards of 6G - make sure they're deleted!
@@ -341,7 +408,7 @@ def copy_to_grid(local_file, grid_file, args, maxrange=MAX_COPY_TRIES):
 def grid_copy(infile, outfile, args, maxrange=MAX_COPY_TRIES):
     print_flush("Copying {0} to {1}".format(infile, outfile))
     protoc = args.gfaldir.split(":")[0]
-    for protocol in PROTOCOLS: # cycle through available protocols until one works.
+    for protocol in list(args.protocols): # cycle through available protocols until one works.
         infile_tmp = infile.replace(protoc, protocol)
         outfile_tmp = outfile.replace(protoc, protocol)
         print_flush("Attempting Protocol {0}".format(protocol))
@@ -351,6 +418,9 @@ def grid_copy(infile, outfile, args, maxrange=MAX_COPY_TRIES):
                 print_flush(cmd)
             retval = syscall(cmd)
             if retval == 0:
+                # Try the protocol that works first for the rest of the job
+                args.protocols.remove(protocol)
+                args.protocols.insert(0, protocol)
                 return retval
             # if copying to the grid and it has failed, remove before trying again
             if retval != 0 and "file" not in outfile and not args.Sockets:
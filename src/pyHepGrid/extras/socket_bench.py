@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+""" Checks that the array based integral handling of socket_server.py gives
+exactly the same results as the original pure python one, and times both.
+With --loopback, also times full iterations of the socket server over
+loopback, with local clients standing in for the grid jobs.
+
+    python3 socket_bench.py -b 500000 -c 20
+    python3 socket_bench.py -b 500000 -c 20 --loopback -i 5 -B 4194304
+"""
+import argparse
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+from array import array
+
+import pyHepGrid.src.socket_server as socket_server
+from pyHepGrid.src.socket_server import Vegas_Socket, add_arrays
+
+
+# Original implementation, kept as the reference
+def legacy_unpack(data):
+    double_array = []
+    for i in range(0, len(data)-1, 8):
+        double_array.append(struct.unpack('d', data[i:i+8])[0])
+    return double_array
+
+
+def legacy_sum(partials):
+    integral_value = len(partials[0])*[0.0]
+    for array_values in partials:
+        integral_value = list(map(lambda x,y: x+y, integral_value, array_values))
+    return integral_value
+
+
+def legacy_pack(total):
+    return b''.join(struct.pack('d', *[double]) for double in total)
+
+
+def receive(payload):
+    """ Sends payload through a socket pair and reads it back with
+    Vegas_Socket.read_partial_integral """
+    left, right = socket.socketpair()
+    sender = threading.Thread(target=left.sendall, args=(payload,))
+    sender.start()
+    partial = Vegas_Socket(right).read_partial_integral(len(payload))
+    sender.join()
+    left.close()
+    right.close()
+    return partial
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter()-start
+
+
+def check_equivalence(bins, clients):
+    payloads = [array('d', (random.uniform(-1e3, 1e3) for _ in range(bins))).tobytes()
+                for _ in range(clients)]
+
+    legacy_partials, t_legacy_unpack = timed(lambda: [legacy_unpack(p) for p in payloads])
+    partials, t_unpack = timed(lambda: [receive(p) for p in payloads])
+    assert all(list(a) == b for a, b in zip(partials, legacy_partials)), "Unpacked arrays differ"
+
+    legacy_total, t_legacy_sum = timed(legacy_sum, legacy_partials)
+    def vector_sum():
+        total = array('d', bytes(8*bins))
+        for partial in partials:
+            add_arrays(total, partial)
+        return total
+    total, t_sum = timed(vector_sum)
+    assert list(total) == legacy_total, "Totals differ"
+
+    legacy_bytes, t_legacy_pack = timed(legacy_pack, legacy_total)
+    total_bytes, t_pack = timed(lambda: bytes(memoryview(total).cast('B')))
+    assert total_bytes == legacy_bytes, "Packed totals differ"
+
+    print("Equivalence check passed for {0} clients x {1} bins (numpy: {2})".format(
+        clients, bins, socket_server.numpy is not None))
+    print("{0:12} {1:>12} {2:>12}".format("", "legacy [s]", "array [s]"))
+    print("{0:12} {1:12.4f} {2:12.4f}".format("unpack", t_legacy_unpack, t_unpack))
+    print("{0:12} {1:12.4f} {2:12.4f}".format("sum", t_legacy_sum, t_sum))
+    print("{0:12} {1:12.4f} {2:12.4f}".format("pack", t_legacy_pack, t_pack))
+
+
+def loopback_client(port, partial, iterations, buffer_size):
+    """ Behaves like a Vegas job: each iteration connects, sends its array
+    and waits for the total """
+    payload = partial.tobytes()
+    for _ in range(iterations):
+        client = Vegas_Socket(buffer_size=buffer_size)
+        client.connect("127.0.0.1", port)
+        client.send_data(len(payload).to_bytes(4, byteorder="little") + payload)
+        total = client.read_partial_integral(len(payload))
+        client.close()
+    return total
+
+
+def loopback_benchmark(bins, clients, iterations, mode, buffer_size):
+    server = Vegas_Socket(logger=logging.getLogger("socket_bench"), buffer_size=buffer_size)
+    server.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind("127.0.0.1", 0, max_connections=clients)
+    port = server.sock.getsockname()[1]
+    if mode == "multiplexed":
+        harmonize_integral = server.harmonize_integral_multiplexed
+    else:
+        harmonize_integral = server.harmonize_integral
+
+    partials = [array('d', (random.uniform(-1e3, 1e3) for _ in range(bins)))
+                for _ in range(clients)]
+    threads = [threading.Thread(target=loopback_client,
+                                args=(port, partial, iterations, buffer_size))
+               for partial in partials]
+    for thread in threads:
+        thread.start()
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        harmonize_integral(clients)
+        durations.append(time.perf_counter()-start)
+    for thread in threads:
+        thread.join()
+    server.close()
+
+    megabytes = 2*clients*bins*8/float(1<<20)
+    print("{0:12} buffer {1:>9}: {2:8.4f}s per iteration (min {3:.4f}s), {4:8.1f} MB/s".format(
+        mode, str(buffer_size or "OS"), sum(durations)/iterations, min(durations),
+        megabytes*iterations/sum(durations)))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-b", "--bins", type=int, default=100000,
+                        help="Number of doubles sent by each client")
+    parser.add_argument("-c", "--clients", type=int, default=10,
+                        help="Number of clients")
+    parser.add_argument("-l", "--loopback", action="store_true",
+                        help="Also time whole iterations of the server over loopback")
+    parser.add_argument("-i", "--iterations", type=int, default=3,
+                        help="Number of iterations for the loopback benchmark")
+    parser.add_argument("-B", "--buffer_sizes", type=int, nargs="*", default=[0],
+                        help="Socket buffer sizes for the loopback benchmark. 0 -> OS default")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    check_equivalence(args.bins, args.clients)
+    if args.loopback:
+        print("Loopback: {0} clients x {1} bins, {2} iterations".format(
+            args.clients, args.bins, args.iterations))
+        for buffer_size in args.buffer_sizes:
+            for mode in ["blocking", "multiplexed"]:
+                loopback_benchmark(args.bins, args.clients, args.iterations, mode, buffer_size)
@@ -51,6 +51,17 @@ provided_warmup_dir = None
 # Finalisation and storage options
 finalise_no_cores = 15
 timeout = 60
+grid_listing_ttl = 300 # Seconds a gfal-ls listing of a grid storage directory is reused before listing it again
+protocol_cache = "~/.pyHepGrid_protocols.json" # Recent gfal results per storage endpoint, used to order PROTOCOLS
+protocol_cache_window = 20 # Number of recent transfers remembered for each protocol and endpoint
+pass_protocols = None # Send the protocol order to the runfile with --protocols. None -> only for the bundled nnlorun.py and hejrun.py
+max_concurrent_commands = 32 # Max number of grid commands run at the same time by utilities.run_commands
+
+# Initialisation options
+init_tar_processes = 4 # Number of runcards tarred up at the same time when initialising
+init_upload_threads = 4 # Number of tarfiles sent to the grid storage at the same time when initialising
+shared_executable = False # Upload the executable once, named by its sha256, instead of inside every runcard tarfile. Needs a runfile that fetches it (bring_executable in nnlorun.py)
+deterministic_tars = True # Identical inputs give byte for byte identical tarfiles, so unchanged uploads can be skipped
 
 # finalisation script, if "None" use native ./main.py man -[DA] -g
 # if using a script, ./main.py will call script.do_finalise()
@@ -66,12 +77,16 @@ warmup_base_dir = "/WarmupsRunGrids"
 production_base_dir = "/ResultsRunGrids"
 
 short_stats = False
+stats_cache_ttl = 120 # Seconds a subjob status from -s is reused before polling it again. 0 -> always poll
 
 # ARC parameters
 ce_base = "base_computing_element.ac.uk"
 ce_test = "test_computing_element.ac.uk"
 ce_listfile = "computing_elements.txt"
 arcbase  = "/path/to/ARC/base/.arc/jobs.dat" # arc database
+arcsub_batch_size = 50 # Number of production jobs sent in a single arcsub call
+ce_submission_list = None # Computing elements to spread production over. None -> ce_base
+arcstat_batch_size = 500 # Number of jobids queried in a single arcstat call by -s
 
 # DIRAC parameters
 dirac_name = "user_name_for_dirac"
@@ -86,6 +101,9 @@ finalise_prefix = None
 server_host = "url.of.the.socket.server"
 port = 9999
 wait_time = 3600 # default waiting time for the socket server (time between the first job activates and nnlojet starting to run)
+socket_fanout = None # Max jobs per relay socket server in ARC socketed warmups. None -> every job talks to the main server
+relay_hosts = None # Hosts the relay socket servers are spread over. None -> server_host
+socket_timeout = None # Seconds the jobs of a socketed iteration have to report once the first one does. None -> wait for all of them
 
 #SLURM parameters
 local_run_directory = "/path/to/local/working/dir/"
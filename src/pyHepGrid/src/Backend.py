@@ -1,6 +1,7 @@
 from collections import Counter
 import datetime
 import os
+import time
 import pyHepGrid.src.dbapi
 from pyHepGrid.src.header import logger
 import pyHepGrid.src.utilities as util
@@ -67,11 +68,17 @@ class Backend(_mode):
         self.assume_yes = False
         self.act_only_on_done = act_only_on_done
         self.stats_one_line = False
+        self.force_refresh = False
+        self.protocols = None # Protocol order sent to the runfile, worked out once per submission
 
     # Helper functions and wrappers
     def dont_ask_dont_tell(self):
         self.assume_yes = True
 
+    def set_force_refresh(self):
+        """ Ignore cached subjob statuses, poll every subjob again """
+        self.force_refresh = True
+
     def set_list_disabled(self):
         self.dbase.set_list_disabled()
 
@@ -101,6 +108,8 @@ class Backend(_mode):
         """ Wrapper for multiprocessing
             For ARC only single thread is allow as the arc database needs
             to be locked
+            Workers must not write to the pyHepGrid database, they return their
+            results so that the parent can store them in a single batched write
         """
         # If required # calls is lower than the # threads given, use the minimum
         if arglen is None:
@@ -112,10 +121,8 @@ class Backend(_mode):
             pool = mp.Pool(threads, initializer=init_counter, initargs=(counter,))
         else:
             pool = mp.Pool(threads)
-        self.dbase.close()
 
         result = pool.map(function, arguments, chunksize=1)
-        self.dbase.reopen()
         pool.close()
         pool.join()
         return result
@@ -200,26 +207,19 @@ class Backend(_mode):
         """ Returns a list of DIRAC/ARC jobids
         for a given database entry
         """
-        jobid = self.dbase.list_data(self.table, ["jobid"], db_id)
-        try:
-            idout = jobid[0]['jobid']
-        except IndexError:
-            logger.info("Selected job is %s out of bounds" % jobid)
+        subjobs = self.dbase.list_subjobs(self.table, db_id, ["jobid", "status"])
+        if not subjobs:
+            logger.info("Selected job is %s out of bounds" % db_id)
             idt   = input("> Select id to act upon: ")
-            idout = self.get_id(idt)
-        jobid_list = idout.split(" ")
+            return self.get_id(idt)
         if self.act_only_on_done:
-            new_list = []
-            status_list = self._get_old_status(db_id)
-            if status_list:
-                for jobid, stat in zip(jobid_list, status_list):
-                    if stat == self.cDONE:
-                        new_list.append(jobid)
-                return new_list
+            if any(subjob["status"] is not None for subjob in subjobs):
+                return [subjob["jobid"] for subjob in subjobs
+                        if subjob["status"] == self.cDONE]
             else:
                 logger.critical("In order to act only on 'done' jobs you need to have that info in the db!")
         else:
-            return jobid_list
+            return [subjob["jobid"] for subjob in subjobs]
 
     def get_date(self, db_id):
         """ Returns date from a given database entry
@@ -233,6 +233,16 @@ class Backend(_mode):
             idout = self.get_date(idt)
         return idout
 
+    def _insert_run(self, dataDict, jobids, seeds=None, ces=None):
+        """ Inserts a new run in the database with one subjob
+        row for each of its jobids
+        """
+        dataDict['jobid'] = ' '.join(jobids)
+        with self.dbase.transaction():
+            run_id = self.dbase.insert_data(self.table, dataDict)
+            self.dbase.insert_subjobs(self.table, run_id, jobids, seeds=seeds, ces=ces)
+        return run_id
+
     def disable_db_entry(self, db_id):
         """ Disable database entry
         """
@@ -252,24 +262,25 @@ class Backend(_mode):
         """ Given a list of jobs, returns the number of jobs which
         are in each possible state (done/waiting/running/etc)
         """
-        jobids = self.get_id(dbid)
-        current_status = self._get_old_status(dbid)
-        arglen = len(jobids)
-
-        if isinstance(current_status, list):
-            if len(current_status)==arglen:
-                jobids_lst = zip(jobids, current_status)
-            else: # Current status corrupted somehow... Start again
-                jobids_lst = jobids
-        else:
-            jobids_lst = jobids
+        subjobs = self.dbase.list_subjobs(self.table, dbid,
+                                          ["jobid", "status", "last_checked"])
+        if self.act_only_on_done:
+            subjobs = [i for i in subjobs if i["status"] == self.cDONE]
+        arglen = len(subjobs)
 
         tags = ["runcard", "runfolder", "date"]
         runcard_info = self.dbase.list_data(self.table, tags, dbid)[0]
 
-        n_threads = header.finalise_no_cores
-        status = self._multirun(self._do_stats_job, jobids_lst,
-                                n_threads, arglen=arglen)
+        # Only poll the subjobs whose cached status is stale
+        checked_time = time.time()
+        stale = [i for i in subjobs if self._is_status_stale(i, checked_time)]
+        header.logger.debug("Using cached status for {0}/{1} subjobs".format(
+                arglen - len(stale), arglen))
+        new_status = {}
+        if stale:
+            polled = self._get_stats_status([(i["jobid"], i["status"]) for i in stale])
+            new_status = {i["rowid"]: j for i, j in zip(stale, polled)}
+        status = [new_status.get(i["rowid"], i["status"]) for i in subjobs]
         done = status.count(self.cDONE)
         wait = status.count(self.cWAIT)
         run = status.count(self.cRUN)
@@ -277,29 +288,35 @@ class Backend(_mode):
         unk = status.count(self.cUNK)
         if do_print:
             self.stats_print_setup(runcard_info, dbid=dbid)
-            total = len(jobids)
+            total = arglen
             self.print_stats(done, wait, run, fail, unk, total)
-        self._set_new_status(dbid, status)
+        if new_status:
+            self.dbase.update_subjob_status(new_status, checked_time=checked_time)
         return done, wait, run, fail, unk
 
-
-    def _get_old_status(self, db_id):
-        field_name = "sub_status"
-        status_dic = self.dbase.list_data(self.table, [field_name], db_id)
-        try:
-            status_str = status_dic[0][field_name]
-            if status_str.lower() == "none":
-                return None
-            else:
-                outlst = [int(i) for i in status_str.split()]
-                return outlst
-        except:
-            return None
+    def _is_status_stale(self, subjob, now):
+        """ Whether the status of subjob has to be polled again: it is not
+        finished and it was last checked longer than stats_cache_ttl ago """
+        if subjob["status"] in [self.cDONE, self.cFAIL]:
+            return False
+        if self.force_refresh or subjob["status"] is None or subjob["last_checked"] is None:
+            return True
+        return now - subjob["last_checked"] >= header.stats_cache_ttl
+
+    def prepare_stats(self, db_ids):
+        """ Called with all the selected db_ids before acting on them one
+        by one, so that backends can query the status of all of them at once
+        """
+        pass
 
     def _set_new_status(self, db_id, status):
-        field_name = "sub_status"
-        status_str = ' '.join(map(str,status))
-        self.dbase.update_entry(self.table, db_id, field_name, status_str)
+        """ Stores the statuses status, a dictionary {jobid : status},
+        for the subjobs of db_id whose status has changed """
+        subjobs = self.dbase.list_subjobs(self.table, db_id, ["jobid", "status"])
+        changed = {subjob["rowid"]: status[subjob["jobid"]] for subjob in subjobs
+                   if subjob["jobid"] in status and subjob["status"] != status[subjob["jobid"]]}
+        if changed:
+            self.dbase.update_subjob_status(changed)
 
     def print_stats(self, done, wait, run, fail, unk, total):
         total2 = done + wait + run + fail + unk
@@ -332,6 +349,13 @@ class Backend(_mode):
             logger.plain("    >> Unknown: {0}".format(unk))
             logger.plain("    >> Sum      {0}".format(total2))
 
+    def _get_stats_status(self, jobids_lst):
+        """ Returns the status of each of the (jobid, stored status) in jobids_lst
+        """
+        n_threads = header.finalise_no_cores
+        return self._multirun(self._do_stats_job, jobids_lst,
+                              n_threads, arglen=len(jobids_lst))
+
     def _do_stats_job(self, jobid_raw):
         """ version of stats job multithread ready
         """
@@ -344,6 +368,11 @@ class Backend(_mode):
             jobid = jobid_raw
         cmd = [self.cmd_stat, jobid.strip(), "-j", header.arcbase]
         strOut = util.getOutputCall(cmd, suppress_errors=True)
+        return self._status_from_arcstat(strOut)
+
+    def _status_from_arcstat(self, strOut):
+        """ Translates the arcstat output of a single job into a status code
+        """
         if "Done" in strOut or "Finished" in strOut:
             return self.cDONE
         elif "Waiting" in strOut or "Queuing" in strOut:
@@ -443,13 +472,9 @@ class Backend(_mode):
         seeds    =  range(initial_seed, finalSeed)
         # If we are only act on a subrange of jobids (ie, the ones which are done...) choose only those seeds
         if self.act_only_on_done:
-            old_status = self._get_old_status(db_id)
-            if old_status:
-                new_seed = []
-                for seed, stat in zip(seeds, old_status):
-                    if stat == self.cDONE:
-                        new_seed.append(seed)
-            seeds = new_seed
+            subjobs = self.dbase.list_subjobs(self.table, db_id, ["seed", "status"])
+            done_seeds = set(i["seed"] for i in subjobs if i["status"] == self.cDONE)
+            seeds = [seed for seed in seeds if seed in done_seeds]
 
         from pyHepGrid.src.header import finalise_no_cores as n_threads
         # Check which of the seeds actually produced some data
@@ -459,9 +484,10 @@ class Backend(_mode):
         logger.info("Found data for {0} of the {1} seeds.".format(len(remote_tarfiles), len(seeds)))
 
         # Download said data
-        tarfiles = self._multirun(self._do_get_data, remote_tarfiles, n_threads, use_counter = True)
-        tarfiles = list(filter(None, tarfiles))
-        logger.info("Downloaded 0 files", end ='\r')
+        local_names = [filename.replace("output", "") for filename in remote_tarfiles]
+        brought = self.gridw.bring_many(remote_tarfiles, header.grid_output_dir,
+                                        local_names, timeout = header.timeout)
+        tarfiles = [filename.replace("output", "") for filename in brought]
         logger.info("Downloaded {0} files, extracting...".format(len(tarfiles)))
 
         # Extract some information from the first tarfile
@@ -475,22 +501,6 @@ class Backend(_mode):
         logger.info("Everything saved at {0}".format(pathfolder))
         util.spCall(["mv", self.rfolder, pathfolder])
 
-    def _do_get_data(self, filename):
-        """ Multithread wrapper used in get_data_production
-        to download information from the grid storage
-        """
-        local_name = filename.replace("output", "")
-        local_file = self.rfolder + "/" + local_name
-        self.gridw.bring(filename, header.grid_output_dir, local_file, timeout = header.timeout)
-        if os.path.isfile(local_name):
-            global counter
-            if counter:
-                counter.value += 1
-                logger.info("Downloaded {0} files ".format(counter.value), end='\r')
-            return local_name
-        else:
-            return None
-
     def _extract_output_warmup_data(self, tarfile):
         """
         Extracts runcard and warmup from a tarfile.
@@ -598,14 +608,25 @@ class Backend(_mode):
             'debug' : str(header.debug_level),
             'gfaldir': header.gfaldir,
             'use_gfal' : str(header.use_gfal),
-            'events' : str(header.events)
+            'events' : str(header.events),
         }
+        if self._runfile_takes_protocols():
+            if self.protocols is None:
+                self.protocols = util.get_protocols()
+            dictionary['protocols'] = self.protocols
         if header.use_cvmfs_lhapdf:
             dictionary.update({
             "use_cvmfs_lhapdf":header.use_cvmfs_lhapdf,
             "cvmfs_lhapdf_location":header.cvmfs_lhapdf_location})
         return dictionary
 
+    def _runfile_takes_protocols(self):
+        """ Custom runfiles may not know about --protocols, so unless told
+        otherwise only the runfiles shipped with pyHepGrid get it """
+        if header.pass_protocols is not None:
+            return header.pass_protocols
+        return os.path.basename(header.runfile) in ["nnlorun.py", "hejrun.py"]
+
     def _make_base_argstring(self, runcard, runtag):
         dictionary = self._get_default_args()
         dictionary['runcard'] = runcard
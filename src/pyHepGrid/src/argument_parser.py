@@ -77,6 +77,7 @@ if caller_script in ("main.py", "pyHepGrid"):
     parser_info = parser.add_argument_group("info options", "Display information about jobs, to be used with mode=man")
     parser_info.add_argument("-s","-S", "--stats", help = "output status statistics for all subjobs in a job", action = "store_true")
     parser_info.add_argument("--simple_string", help = "To be used with -s/-S, prints one liners for done/total", action = "store_true")
+    parser_info.add_argument("--force_refresh", help = "To be used with -s/-S, poll all unfinished subjobs ignoring the cached status", action = "store_true")
     parser_info.add_argument("-C", "--checkwarmup", help = "Check completed warmup to see if a warmup file is present", action = "store_true")
     parser_info.add_argument("--resubmit", help = "Resubmit if warmup not present. For use with --checkwarmup only", action = "store_true")
     parser_info.add_argument("-c","--completion", help = "Show current iteration completion of running jobs", action = "store_true")
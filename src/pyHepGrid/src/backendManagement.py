@@ -56,8 +56,9 @@ class Arc(Backend):
 
     def renew_proxy(self, jobids):
         """ renew proxy for a given job """
-        for jobid in jobids:
-            cmd = [self.cmd_renew, jobid.strip()]
+        # One call per batch, they all share the arc job list
+        for jobid_set in util.batch_gen(jobids, 150):
+            cmd = [self.cmd_renew] + [i.strip() for i in jobid_set]
             util.spCall(cmd)
 
     def kill_job(self, jobids, jobinfo):
@@ -77,23 +78,22 @@ class Arc(Backend):
         """ remove the sandbox of a given job (including its stdout!) from
         the arc storage """
         self._press_yes_to_continue("  \033[93m WARNING:\033[0m You are about to clean the job!")
-        for jobid in jobids:
-            cmd = [self.cmd_clean, "-j", header.arcbase, jobid.strip()]
+        for jobid_set in util.batch_gen(jobids, 150):
+            cmd = [self.cmd_clean, "-j", header.arcbase] + [i.strip() for i in jobid_set]
             util.spCall(cmd)
 
     def cat_job(self, jobids, jobinfo, print_stderr = None, store = False):
         """ print stdandard output of a given job"""
-        out = []
+        cmds = []
         for jobid in jobids:
             cmd = [self.cmd_print, "-j", header.arcbase, jobid.strip()]
             if print_stderr:
                 cmd += ["-e"]
-            if not store:
-                util.spCall(cmd)
-            else:
-                out.append(util.getOutputCall(cmd))
+            cmds.append(cmd)
         if store:
-            return out
+            return util.getOutputCall_many(cmds)
+        for cmd in cmds:
+            util.spCall(cmd)
 
 
     def cat_log_job(self, jobids, jobinfo):
@@ -124,13 +124,51 @@ class Arc(Backend):
             finfolder = header.default_runfolder
         jobids    =  data["jobid"].split()
         output_folder = ["file://" + finfolder]
+        cmds = []
         for jobid in jobids:
-            cmd = cmd_base + [jobid + "/*.y*"] + output_folder
-            util.spCall(cmd)
-            cmd = cmd_base + [jobid + "/*.log"] + output_folder
-            util.spCall(cmd)
+            cmds.append(cmd_base + [jobid + "/*.y*"] + output_folder)
+            cmds.append(cmd_base + [jobid + "/*.log"] + output_folder)
+        util.spCall_many(cmds)
         print("Warmup stored at {0}".format(finfolder))
 
+    def _get_stats_status(self, jobids_lst):
+        """ Jobs already done or failed keep their stored status, the rest
+        are queried with a single arcstat call per batch of jobids
+        """
+        finished = [self.cDONE, self.cFAIL]
+        to_check = [jobid.strip() for jobid, status in jobids_lst
+                    if status not in finished]
+        batches = list(util.batch_gen(to_check, header.arcstat_batch_size))
+        states = {}
+        if batches:
+            for batch_states in self._multirun(self._do_stats_batch, batches,
+                                               header.finalise_no_cores,
+                                               arglen=len(batches)):
+                states.update(batch_states)
+        return [status if status in finished else states.get(jobid.strip(), self.cUNK)
+                for jobid, status in jobids_lst]
+
+    def _do_stats_batch(self, jobids):
+        """ multiproc wrapper: runs arcstat for a batch of jobids and returns
+        a dictionary {jobid : status}. Jobs missing in the output are unknown
+        """
+        cmd = [self.cmd_stat, "-j", header.arcbase] + jobids
+        strOut = util.getOutputCall(cmd, suppress_errors=True)
+        return self._parse_arcstat(strOut)
+
+    def _parse_arcstat(self, strOut):
+        """ Splits multi-job arcstat output in one block per "Job:" line
+        and translates the state of each of them """
+        states = {}
+        jobid = None
+        for line in strOut.splitlines():
+            if line.startswith("Job:"):
+                jobid = line.split(":", 1)[1].strip()
+                states[jobid] = self.cUNK
+            elif jobid is not None and line.strip().startswith("State:"):
+                states[jobid] = self._status_from_arcstat(line)
+        return states
+
     def status_job(self, jobids, verbose = False):
         """ print the current status of a given job """
         # for jobid in jobids:
@@ -154,6 +192,8 @@ class Dirac(Backend):
     def __init__(self, **kwargs):
         super(Dirac, self).__init__(**kwargs)
         self.table = header.diractable
+        # {date : {jobid : state}}, shared by all database entries
+        self._dirac_states = {}
 
     def __str__(self):
         return "Dirac"
@@ -182,6 +222,17 @@ class Dirac(Backend):
         header.logger.debug(output)
         return output
 
+    def get_states(self, date):
+        """ Returns a dictionary {jobid : state} with all jobs from date.
+        Each state is only queried once per date for every database entry """
+        if date not in self._dirac_states:
+            states = {}
+            for state in ["Waiting", "Done", "Running", "Failed", "Unknown"]:
+                for jobid in self.get_status(state, date):
+                    states[jobid] = state
+            self._dirac_states[date] = states
+        return self._dirac_states[date]
+
     def stats_job(self, dbid):
         """ When using Dirac, instead of asking for each job individually
         we can ask for batchs of jobs in a given state and compare.
@@ -190,32 +241,19 @@ class Dirac(Backend):
         tags = ["runcard", "runfolder", "date"]
         runcard_info = self.dbase.list_data(self.table, tags, dbid)[0]
 
-        try:
-            self.__first_call_stats
-        except AttributeError as e:
-            self.__first_call_stats = False
         date = runcard_info["date"].split()[0]
-        jobids_set = set(jobids)
         # Get all jobs in each state
-        waiting_jobs = self.get_status('Waiting', date)
-        done_jobs = self.get_status('Done', date)
-        running_jobs = self.get_status('Running', date)
-        fail_jobs = self.get_status('Failed', date)
-        unk_jobs = self.get_status('Unknown', date)
-        failed_jobs_set = jobids_set & fail_jobs
-        done_jobs_set = jobids_set & done_jobs
+        states = self.get_states(date)
+        job_states = [states.get(jobid) for jobid in set(jobids)]
         # Count how many jobs we have in each state
-        fail = len(failed_jobs_set)
-        done = len(done_jobs_set)
-        wait = len(jobids_set & waiting_jobs)
-        run = len(jobids_set & running_jobs)
-        unk = len(jobids_set & unk_jobs)
+        fail = job_states.count("Failed")
+        done = job_states.count("Done")
+        wait = job_states.count("Waiting")
+        run = job_states.count("Running")
+        unk = job_states.count("Unknown")
         # Save done and failed jobs to the database
-        status = len(jobids)*[0]
-        for jobid in failed_jobs_set:
-            status[jobids.index(jobid)] = self.cFAIL
-        for jobid in done_jobs_set:
-            status[jobids.index(jobid)] = self.cDONE
+        state_to_status = {"Failed": self.cFAIL, "Done": self.cDONE}
+        status = {jobid: state_to_status.get(states.get(jobid), 0) for jobid in jobids}
         self.stats_print_setup(runcard_info,dbid = dbid)
         total = len(jobids)
         self.print_stats(done, wait, run, fail, unk, total)
@@ -241,6 +279,8 @@ class Slurm(Backend):
         else:
             self.table = header.slurmtable
         self.production = production
+        # {array jobid : {array task : slurm state}}
+        self._slurm_states = {}
 
     def __str__(self):
         retstr = "Slurm"
@@ -318,28 +358,84 @@ class Slurm(Backend):
 
 
 
-    def get_status(self, jobid, status):
-        stat = len([i for i in util.getOutputCall(["squeue", "-j{0}".format(jobid),"-r","-t",status],
-                                                  suppress_errors=True).split("\n")[1:]
-                    if "error" not in i]) #strip header from results
-        if stat >0:
-            stat = stat-1
-        return stat
-
+    def prepare_stats(self, db_ids):
+        """ Query the state of the array jobs of all db_ids at once """
+        jobids = []
+        for db_id in db_ids:
+            jobids += [i["jobid"] for i in self.dbase.list_subjobs(self.table, db_id, ["jobid"])]
+        self._slurm_states.update(self._query_slurm_states(jobids))
+
+    def _query_slurm_states(self, jobids):
+        """ Returns {jobid : {array task : state}} for all jobids using a
+        single sacct call and a single squeue call. squeue is more up to date
+        for jobs still in the queue, so it overrides sacct """
+        jobids = sorted(set(str(i).strip() for i in jobids))
+        states = {jobid: {} for jobid in jobids}
+        if not jobids:
+            return states
+        joblist = ",".join(jobids)
+        sacct = util.getOutputCall(["sacct", "-n", "-X", "-P", "-j", joblist,
+                                    "--format=JobID,State"], suppress_errors=True)
+        squeue = util.getOutputCall(["squeue", "-h", "-r", "-t", "all", "-j", joblist,
+                                     "-o", "%i %t"], suppress_errors=True)
+        for output, separator in [(sacct, "|"), (squeue, None)]:
+            for line in output.splitlines():
+                fields = line.split(separator)
+                if len(fields) < 2 or not fields[1].strip():
+                    continue
+                jobid, _, tasks = fields[0].strip().partition("_")
+                if jobid not in states:
+                    continue
+                for task in self._expand_array_tasks(tasks):
+                    # sacct reports e.g. "CANCELLED by 1234"
+                    states[jobid][task] = fields[1].split()[0]
+        return states
+
+    def _expand_array_tasks(self, tasks):
+        """ Expands a slurm array task specification such as [1-3,7%2] """
+        tasks = tasks.strip("[]").split("%")[0]
+        expanded = []
+        for task in tasks.split(","):
+            if "-" in task:
+                first, last = task.split("-")
+                expanded += [str(i) for i in range(int(first), int(last)+1)]
+            else:
+                expanded.append(task)
+        return expanded
+
+    def _slurm_status(self, state):
+        """ Translates a squeue (compact) or sacct state into a status code """
+        if state in ["R", "RUNNING"]:
+            return self.cRUN
+        elif state in ["PD", "PENDING"]:
+            return self.cWAIT
+        elif state in ["F", "CA", "TO", "NF", "OOM", "BF", "DL",
+                       "FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL",
+                       "OUT_OF_MEMORY", "BOOT_FAIL", "DEADLINE"]:
+            return self.cFAIL
+        else:
+            return self.cDONE
+
+    def _count_slurm_states(self, jobids):
+        """ Returns the number of done, waiting, running and failed array tasks
+        for jobids, and their total, querying slurm only for jobids whose
+        state hasn't been prepared yet """
+        jobids = [str(i).strip() for i in jobids]
+        missing = [i for i in jobids if i not in self._slurm_states]
+        if missing:
+            self._slurm_states.update(self._query_slurm_states(missing))
+        status = []
+        for jobid in jobids:
+            status += [self._slurm_status(i) for i in self._slurm_states[jobid].values()]
+        return (status.count(self.cDONE), status.count(self.cWAIT),
+                status.count(self.cRUN), status.count(self.cFAIL), len(status))
 
     def stats_job(self, dbid):
         tags = ["runcard", "runfolder", "date"]
         jobids = self.get_id(dbid) # only have one array id for SLURM
         runcard_info = self.dbase.list_data(self.table, tags, dbid)[0]
-        running, waiting, fail, tot = 0,0,0,0
-        for jobid in jobids:
-            running += self.get_status(jobid,"R")
-            waiting += self.get_status(jobid,"PD")
-            fail += self.get_status(jobid,"F")+self.get_status(jobid,"CA")
-            tot += self.get_status(jobid,"all")
-        done = tot-fail-waiting-running
+        done, waiting, running, fail, tot = self._count_slurm_states(jobids)
         self.stats_print_setup(runcard_info,dbid = dbid)
-        total = len(jobids)
         self.print_stats(done, waiting, running, fail, 0, tot)
 
 
@@ -390,14 +486,7 @@ class Slurm(Backend):
 
     def status_job(self, jobids, verbose = False):
         """ print the current status of a given job """
-        running,waiting,fail,tot = 0,0,0,0
-        for jobid in jobids:
-            running += self.get_status(jobid,"R")
-            waiting += self.get_status(jobid,"PD")
-            fail += self.get_status(jobid,"F")+self.get_status(jobid,"CA")
-            tot += self.get_status(jobid,"all")
-        done = tot-fail-waiting-running
-        total = len(jobids)
+        done, waiting, running, fail, tot = self._count_slurm_states(jobids)
         self.print_stats(done, waiting, running, fail, 0, tot)
 
 
@@ -1,26 +1,96 @@
+import os
 import sqlite3 as dbapi
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+SUBJOB_TABLE = "subjobs"
+# (name, type) of every field in the subjob table
+SUBJOB_FIELDS = [("runtable", "text"), ("run_id", "integer"), ("seed", "integer"),
+                 ("jobid", "text"), ("ce", "text"), ("status", "integer"),
+                 ("last_checked", "real")]
+
+# Connections are shared by every database object of a process, keyed by
+# (dbname, pid) so forked workers open their own instead of reusing the parent's
+_connections = {}
+# Tables whose fields have already been checked, for each dbname
+_checked_tables = {}
+
+
+class _connection(object):
+    """ A sqlite connection and the depth of the open transaction blocks """
+    def __init__(self, dbname):
+        self.db = dbapi.connect(dbname, check_same_thread=True)
+        # WAL journaling: readers don't block the writer and commits are cheaper
+        self.db.execute("pragma journal_mode=wal;")
+        self.transaction_depth = 0
+
+
+def _get_connection(dbname):
+    """ Returns the connection to dbname of this process, opening it if needed """
+    key = (dbname, os.getpid())
+    if key not in _connections:
+        _connections[key] = _connection(dbname)
+    return _connections[key]
 
 
 class database(object):
     def __init__(self, db, tables = None, fields = None, logger=None):
         self._setup_logger(logger)
         self.dbname = db
-        self.db = dbapi.connect(db, check_same_thread=True)
         self.list_disabled = False
+        checked = _checked_tables.setdefault(db, set())
         if tables:
             # check whether table exists and create it othewise
             for table in tables:
+                if table in checked:
+                    continue
                 if self._is_this_table_here(table):
                     # if table does exist, check the list of tables is correct and correct it otherwise
                     self._protect_fields(table, fields)
                 else:
                     self._create_table(table, fields)
+                checked.add(table)
+        if SUBJOB_TABLE not in checked:
+            if not self._is_this_table_here(SUBJOB_TABLE):
+                self._create_subjob_table()
+                if tables:
+                    self._migrate_to_subjobs(tables)
+            checked.add(SUBJOB_TABLE)
+
+    @property
+    def db(self):
+        return _get_connection(self.dbname).db
 
     def close(self):
-        self.db = None
+        """ Commits and closes the connection of this process.
+        It is opened again the next time it is used """
+        connection = _connections.pop((self.dbname, os.getpid()), None)
+        if connection is not None:
+            connection.db.commit()
+            connection.db.close()
 
     def reopen(self):
-        self.db = dbapi.connect(self.dbname)
+        _get_connection(self.dbname)
+
+    @contextmanager
+    def transaction(self):
+        """ Groups every statement executed inside the block in a single commit.
+        Transactions can be nested, only the outermost one commits.
+        Statements already executed are committed even if the block raises,
+        as they would have been when committing after each statement. """
+        connection = _get_connection(self.dbname)
+        connection.transaction_depth += 1
+        try:
+            yield self
+        finally:
+            connection.transaction_depth -= 1
+            self._commit()
+
+    def _commit(self):
+        """ Commits unless inside a transaction block """
+        connection = _get_connection(self.dbname)
+        if connection.transaction_depth == 0:
+            connection.db.commit()
 
     def _setup_logger(self, logger):
         if logger is not None:
@@ -41,24 +111,41 @@ class database(object):
         for field in new_fields:
             self._insert_field_in_table(table, field, "text")
 
-    def _execute_and_commit(self, query):
-        """ Executes a query and commits to the database """
-        database.logger.debug("<SQL> {0}".format(query))
+    def _execute_and_commit(self, query, params = ()):
+        """ Executes a query and commits to the database
+        Returns the rowid of the last inserted row """
+        database.logger.debug("<SQL> {0} {1}".format(query, params))
         c = self.db.cursor()
         try:
-            c.execute(query)
+            c.execute(query, params)
         except Exception as e:
             database.logger.critical("Executed query: {0}".format(query))
             raise e # For default case w/ no logger
+        rowid = c.lastrowid
         c.close()
-        self.db.commit()
+        self._commit()
+        return rowid
 
-    def _execute_and_retrieve(self, query):
+    def _executemany_and_commit(self, query, seq_params):
+        """ Executes a query once for each set of parameters in seq_params
+        and commits to the database once """
+        seq_params = list(seq_params)
+        database.logger.debug("<SQL> {0} x{1}".format(query, len(seq_params)))
+        c = self.db.cursor()
+        try:
+            c.executemany(query, seq_params)
+        except Exception as e:
+            database.logger.critical("Executed query: {0}".format(query))
+            raise e # For default case w/ no logger
+        c.close()
+        self._commit()
+
+    def _execute_and_retrieve(self, query, params = ()):
         """ Executes a query and returns the cursor """
-        database.logger.debug("<SQL> {0}".format(query))
+        database.logger.debug("<SQL> {0} {1}".format(query, params))
         c = self.db.cursor()
         try:
-            c.execute(query)
+            c.execute(query, params)
         except Exception as e:
             database.logger.critical("Executed query: {0}".format(query))
             raise e # For default case w/ no logger
@@ -80,10 +167,61 @@ class database(object):
         self._execute_and_commit(head + tail)
         return 0
 
+    def _create_subjob_table(self):
+        """ Creates the subjob table, which stores one row per jobid
+        of every run in the run tables, and its indexes
+        """
+        database.logger.info("Creating new table: {0}".format(SUBJOB_TABLE))
+        tail = ", ".join("{0} {1}".format(field, f_type) for field, f_type in SUBJOB_FIELDS)
+        self._execute_and_commit("create table {0} ({1});".format(SUBJOB_TABLE, tail))
+        self._execute_and_commit("create index {0}_run on {0} (runtable, run_id);".format(SUBJOB_TABLE))
+        self._execute_and_commit("create index {0}_jobid on {0} (jobid);".format(SUBJOB_TABLE))
+
+    def _migrate_to_subjobs(self, tables):
+        """ Fills the subjob table from the space separated jobid/sub_status
+        fields of every run already in tables
+        """
+        with self.transaction():
+            for table in sorted(set(tables)):
+                c = self._execute_and_retrieve("select rowid from {0};".format(table))
+                run_ids = [i[0] for i in c]
+                c.close()
+                if run_ids:
+                    database.logger.info("Migrating {0} runs of {1} to {2}".format(
+                            len(run_ids), table, SUBJOB_TABLE))
+                for run_id in run_ids:
+                    self._migrate_run(table, run_id)
+
+    def _migrate_run(self, table, run_id):
+        """ Creates the subjob rows of a run from its jobid, sub_status,
+        iseed and queue fields. Returns False if the run doesn't exist """
+        keys = ["jobid", "sub_status", "iseed", "queue"]
+        data = self.list_data(table, keys, run_id)
+        if not data or not data[0]["jobid"]:
+            return False
+        data = data[0]
+        jobids = data["jobid"].split()
+        try:
+            statuses = [int(i) for i in data["sub_status"].split()]
+        except (AttributeError, ValueError) as e:
+            statuses = []
+        if len(statuses) != len(jobids):
+            statuses = len(jobids)*[None]
+        try:
+            seeds = [int(data["iseed"]) + i for i in range(len(jobids))]
+        except (TypeError, ValueError) as e:
+            seeds = None
+        ces = (data["queue"] or "").split()
+        if len(ces) != len(jobids):
+            ces = [urlparse(jobid).hostname for jobid in jobids]
+        self.insert_subjobs(table, run_id, jobids, seeds = seeds, ces = ces,
+                            statuses = statuses)
+        return True
+
     def _is_this_table_here(self, table):
         """ Checks whether table table exists"""
-        query = "SELECT name FROM sqlite_master WHERE type='table' AND name='{}';".format(table)
-        c = self._execute_and_retrieve(query)
+        query = "SELECT name FROM sqlite_master WHERE type='table' AND name=?;"
+        c = self._execute_and_retrieve(query, (table,))
         for i in c:
             c.close()
             return True
@@ -130,26 +268,66 @@ class database(object):
         self.list_disabled = True
 
     def insert_data(self, table, dataDict):
-        """ Insert dataDict in table table """
+        """ Insert dataDict in table table
+        Returns the rowid of the new entry """
         keys = [key for key in dataDict]
         data = [dataDict[k] for k in keys]
+        return self._execute_and_commit(self._insert_query(table, keys), data)
+
+    def _insert_query(self, table, keys):
         head = "insert into {0} ({1})".format(table, ", ".join(keys))
-        tail = "values ('{}');".format("', '".join(data))
-        query = head + " " + tail
-        self._execute_and_commit(query)
+        tail = "values ({0});".format(", ".join(len(keys)*["?"]))
+        return head + " " + tail
+
+    def insert_subjobs(self, table, run_id, jobids, seeds = None, ces = None,
+                       statuses = None):
+        """ Insert one subjob row per jobid for the run run_id of table """
+        n_jobs = len(jobids)
+        seeds = seeds or n_jobs*[None]
+        ces = ces or n_jobs*[None]
+        statuses = statuses or n_jobs*[None]
+        query = "insert into {0} (runtable, run_id, seed, jobid, ce, status) values (?, ?, ?, ?, ?, ?);".format(SUBJOB_TABLE)
+        rows = [(table, int(run_id), seed, jobid, ce, status)
+                for jobid, seed, ce, status in zip(jobids, seeds, ces, statuses)]
+        self._executemany_and_commit(query, rows)
+
+    def list_subjobs(self, table, run_id, keys):
+        """ List fields keys (plus the subjob rowid) for all subjobs of run_id,
+        in submission order. Runs predating the subjob table are migrated first
+        """
+        query = "select rowid, {0} from {1} where runtable = ? and run_id = ? order by rowid;".format(
+            ",".join(keys), SUBJOB_TABLE)
+        params = (table, int(run_id))
+        c = self._execute_and_retrieve(query, params)
+        rows = c.fetchall()
+        c.close()
+        if not rows and self._migrate_run(table, run_id):
+            c = self._execute_and_retrieve(query, params)
+            rows = c.fetchall()
+            c.close()
+        return [dict(zip(["rowid"] + keys, row)) for row in rows]
+
+    def update_subjob_status(self, new_status, checked_time = None):
+        """ Update the status of the subjobs in the dictionary
+        new_status {subjob rowid : status}. Only one commit is done """
+        query = "update {0} set status = ?, last_checked = coalesce(?, last_checked) where rowid = ?;".format(SUBJOB_TABLE)
+        self._executemany_and_commit(query, ((status, checked_time, rowid)
+                                             for rowid, status in new_status.items()))
 
     def list_data(self, table, keys, job_id = None):
         """ List fields keys for active entries in database unless job_id is provided
         in which case only list job_id run"""
         keystr = ",".join(keys)
+        params = ()
         if job_id:
-            optional = "where rowid = {}".format(job_id)
+            optional = "where rowid = ?"
+            params = (job_id,)
         elif not self.list_disabled:
-            optional = "where status = \"active\""
+            optional = "where status = 'active'"
         else:
             optional = ""
         query = "select {0} from {1} {2};".format(keystr, table, optional)
-        c = self._execute_and_retrieve(query)
+        c = self._execute_and_retrieve(query, params)
         dataList = []
         for i in c:
             tmpDic = {}
@@ -166,13 +344,14 @@ class database(object):
         if self.list_disabled:
             search_string = "where ("
         else:
-            search_string = "where (status = \"active\") AND ("
+            search_string = "where (status = 'active') AND ("
         search_queries = []
         for field in find_in:
-            search_queries.append("{0} like '%{1}%'".format(field, find_this))
+            search_queries.append("{0} like ?".format(field))
         search_string += " OR ".join(search_queries) + ")"
         query = "select {0} from {1} {2};".format(keystr, table, search_string)
-        c = self._execute_and_retrieve(query)
+        params = len(find_in)*["%{0}%".format(find_this)]
+        c = self._execute_and_retrieve(query, params)
         dataList = []
         for i in c:
             tmpDic = {}
@@ -184,19 +363,16 @@ class database(object):
 
     def update_entry(self, table, rowid, field, new_value):
         """ Update a given field for a given table for a given dbid! """
-        query_raw = "update {0} set {1} = \"{2}\" where rowid = {3} ;"
-        query = query_raw.format(table, field, new_value, rowid)
-        self._execute_and_commit(query)
+        query = "update {0} set {1} = ? where rowid = ? ;".format(table, field)
+        self._execute_and_commit(query, (new_value, rowid))
 
     def disable_entry(self, table, rowid, revert = None):
         """ Disables (or enables) rowid entry"""
         newStat = "inactive"
         if revert:
             newStat = "active"
-        query = "update " + table + " set status = \"" + newStat + "\""
-        rid = " where rowid = " + rowid + " ;"
-        total_query = query + rid
-        self._execute_and_commit(total_query)
+        query = "update " + table + " set status = ? where rowid = ? ;"
+        self._execute_and_commit(query, (newStat, rowid))
 
 def get_next_seed(dbname=None):
     from pyHepGrid.src.header import arctable, arcprodtable, diractable, slurmtable, slurmprodtable, dbfields, logger
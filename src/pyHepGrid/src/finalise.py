@@ -1,28 +1,40 @@
 #!/usr/bin/env python3
 from __future__ import division, print_function
+import contextlib
 import datetime
 import glob
 import importlib
 import itertools as it
+import json
 import multiprocessing as mp
 import os
 import re
 import pyHepGrid.src.header as config
+import pyHepGrid.src.utilities as util
+import shutil
 import subprocess
 import tarfile
+import tempfile
 import sys
+import zlib
+from collections import Counter
 
 logseed_regex = re.compile(r".s([0-9]+)\.[^\.]+$") # Matches seeds in logfiles
 tarfile_regex = re.compile(r"-([0-9]+)\.tar.gz+$") # Matches tarfiles
 logfile_regex = re.compile(r"\w+\.\w+\.s([0-9]+)\.log") # Matches PROGRAM log files
+index_regex = re.compile(r"^output(.+)-([0-9]+)\.tar\.gz$") # Matches runcard-tag and seed of tarfiles
 
 # CONFIG
 no_processes = config.finalise_no_cores
 verbose = config.verbose_finalise
 DELETE_CORRUPTED = False
 MAX_ATTEMPTS = 5
+STREAM_PULL = True # Extract tarfiles as they are downloaded, the last attempt is always a gfal-copy
+PULL_POLICY = util.RetryPolicy(max_attempts=MAX_ATTEMPTS) # Backoff between attempts of a pull
 FINALISE_ALL = True
 RECURSIVE = config.recursive_finalise
+INDEX_FILE = ".finalise_index.json"
+MANIFEST_FILE = ".finalise_manifest"
 ls_protocol = "dav"
 copy_protocol = "xroot"
 
@@ -57,22 +69,175 @@ def get_output_dir_name(runcard, rtag):
         return os.path.join(basedir, rtag, subdir)
 
 
+def get_index_file(currentdir, rtag):
+    if rtag is None:
+        return os.path.join(currentdir, config.production_base_dir, INDEX_FILE)
+    else:
+        return os.path.join(currentdir, config.production_base_dir, rtag, INDEX_FILE)
+
+
+def build_index(output):
+    """ Indexes the tarfiles of a gfal-ls -l listing as
+    {runcard-tag : {seed : [filename, size, modification time]}} """
+    index = {}
+    for x in output:
+        if x[0][0] == "d":
+            continue
+        match = index_regex.match(x[-1])
+        if match is None:
+            continue
+        size = x[4] if len(x) > 5 else ""
+        mtime = " ".join(x[5:-1])
+        index.setdefault(match.group(1), {})[match.group(2)] = [x[-1], size, mtime]
+    return index
+
+
+def load_index(index_file):
+    """ Index stored by the previous finalise of this folder, if any """
+    try:
+        with open(index_file) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        return {}
+
+
+def save_index(index_file, index):
+    mkdir(os.path.dirname(index_file))
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_file, index_file)
+
+
 def get_PROGRAM_logfiles(logdir):
     for i in os.listdir(logdir):
         if logfile_regex.match(i) is not None:
             yield i
 
 
-def createdirs(currentdir, runcard, rtag):
+def load_manifest(logdir):
+    """ Seeds already pulled into logdir as {seed : [size, modification time]}
+    of the remote file they came from. The manifest is append only, so later
+    lines override earlier ones """
+    manifest = {}
+    with open(os.path.join(logdir, MANIFEST_FILE)) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 3:
+                manifest[fields[0]] = fields[1:]
+    return manifest
+
+
+def append_manifest(logdir, entries):
+    """ Records the seeds in entries {seed : [size, modification time]} as pulled """
+    with open(os.path.join(logdir, MANIFEST_FILE), "a") as f:
+        for seed, (size, mtime) in entries.items():
+            f.write("{0}\t{1}\t{2}\n".format(seed, size, mtime))
+
+
+def createdirs(currentdir, runcard, rtag, remote_files):
     targetdir = os.path.join(currentdir, get_output_dir_name(runcard, rtag))
     mkdir(targetdir)
     logdir = os.path.join(targetdir, 'log')
     mkdir(logdir)
     nodedir = os.path.join(logdir, 'node_info')
     mkdir(nodedir)
-    logcheck = set([logseed_regex.search(i).group(1) for i
-                    in get_PROGRAM_logfiles(logdir)])
-    return logcheck, targetdir
+    if not os.path.isfile(os.path.join(logdir, MANIFEST_FILE)):
+        # First pull with a manifest: assume seeds with logs match the remote files
+        logcheck = set([logseed_regex.search(i).group(1) for i
+                        in get_PROGRAM_logfiles(logdir)])
+        append_manifest(logdir, {seed: remote_files[seed][1:] for seed in logcheck
+                                 if seed in remote_files})
+    return load_manifest(logdir), targetdir
+
+
+# Where the files staged in each subfolder of the extraction directory end up
+STAGED_DIRS = {"dat": "../", "log": "../log/", "node_info": "../log/node_info/"}
+
+
+def extract_output(tfile, seed, stagedir):
+    """ Extracts the .dat and .log files of tfile (read sequentially) into
+    the dat/log/node_info subfolders of stagedir. Returns True if none were found """
+    corrupted = True
+    for t in tfile:
+        if t.name.endswith(".dat"):
+            tfile.extract(t,path=os.path.join(stagedir, "dat"))
+            corrupted = False
+        elif t.name.endswith(".log") and "node_info" not in t.name:
+            tfile.extract(t,os.path.join(stagedir, "log"))
+            corrupted = False
+        elif t.name.endswith(".log") and "node_info"in t.name and t.isfile():
+            mkdir(os.path.join(stagedir, "node_info"))
+            with open(os.path.join(stagedir, "node_info", "node_info_{0}.log".format(seed)), "wb") as f:
+                shutil.copyfileobj(tfile.extractfile(t), f)
+    return corrupted
+
+
+@contextlib.contextmanager
+def staging(seed):
+    """ Temporary directory the output of seed is extracted into, so that
+    a pull which fails halfway leaves no partial files behind """
+    stagedir = tempfile.mkdtemp(prefix=".pull_s{0}_".format(seed), dir=".")
+    try:
+        yield stagedir
+    finally:
+        shutil.rmtree(stagedir, ignore_errors=True)
+
+
+def move_staged(stagedir):
+    """ Moves the files extracted into stagedir to their final place """
+    for subdir, target in STAGED_DIRS.items():
+        staged = os.path.join(stagedir, subdir)
+        for root, dirs, files in os.walk(staged):
+            destdir = os.path.join(target, os.path.relpath(root, staged))
+            for filename in files:
+                mkdir(destdir)
+                os.replace(os.path.join(root, filename), os.path.join(destdir, filename))
+
+
+def transfer_failure(stderr):
+    """ Reason for a failed gfal command given its stderr """
+    if "No such file" in stderr or "ENOENT" in stderr:
+        return util.FAIL_MISSING
+    return util.FAIL_TRANSFER
+
+
+def extract_failure(seed, stagedir, **kwargs):
+    """ Opens the gzipped tarfile given by kwargs (name or fileobj) as a stream
+    and extracts it into stagedir. Returns the reason if it failed, None otherwise """
+    try:
+        with tarfile.open(mode='r|gz', **kwargs) as tfile:
+            if extract_output(tfile, seed, stagedir):
+                return util.FAIL_EMPTY
+    except EOFError as e:
+        return util.FAIL_TRUNCATED
+    except (tarfile.TarError, zlib.error) as e:
+        if "truncated" in str(e) or "unexpected end of data" in str(e):
+            return util.FAIL_TRUNCATED
+        return util.FAIL_CORRUPT
+    return None
+
+
+def stream_pull(gridname, seed):
+    """ Pipes gfal-cat straight into the gzip/tar decoder, so that only the
+    extracted files are written to disk.
+    Returns the reason if the pull failed, None otherwise """
+    cmd = ["gfal-cat"] + timeoutstr.split() + [gridname]
+    with tempfile.TemporaryFile() as errfile, staging(seed) as stagedir:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errfile)
+        failure = extract_failure(seed, stagedir, fileobj=proc.stdout)
+        # Consume the end of the stream so that gfal-cat can exit cleanly
+        while proc.stdout.read(65536):
+            pass
+        proc.stdout.close()
+        if proc.wait() != 0:
+            # The transfer itself failed, which takes precedence over whatever
+            # the decoder made of the partial stream
+            errfile.seek(0)
+            failure = transfer_failure(errfile.read().decode("utf-8", "replace"))
+        if failure is None:
+            move_staged(stagedir)
+    return failure
 
 
 def pullrun(name, seed, run, tmpdir, subfolder, attempts=0):
@@ -95,39 +260,32 @@ def pullrun(name, seed, run, tmpdir, subfolder, attempts=0):
     gridname = os.path.join(config.gfaldir, __folder, name)
     gridname = ":".join([copy_protocol, gridname.split(":", 1)[-1]])
 
-    command = 'gfal-copy {0} {1} {2} > /dev/null 2>&1'.format(gridname, name, timeoutstr)
-    
-    os.system(command)
-
-    corrupted = True
-    try:
-        with tarfile.open(name, 'r|gz') as tfile:
-            for t in tfile:
-                if t.name.endswith(".dat"):
-                    tfile.extract(t,path="../")
-                    corrupted = False
-                elif t.name.endswith(".log") and "node_info" not in t.name:
-                    tfile.extract(t,"../log/")
-                    corrupted = False
-                elif t.name.endswith(".log") and "node_info"in t.name:
-                    tfile.extract(t,"../log/node_info/")
-                    os.rename("../log/node_info/"+t.name,
-                              "../log/node_info/node_info_{0}.log".format(seed))
-        os.remove(name)
-    except (FileNotFoundError, tarfile.ReadError) as e:
-        # pull error - corrupted stays True
-        pass
-
-    if corrupted:
-        if attempts<MAX_ATTEMPTS-1:
+    if STREAM_PULL and attempts < MAX_ATTEMPTS-1:
+        failure = stream_pull(gridname, seed)
+    else:
+        command = ["gfal-copy", gridname, name] + timeoutstr.split()
+        copy = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if not os.path.isfile(name):
+            failure = transfer_failure(copy.stderr.decode("utf-8", "replace"))
+        else:
+            with staging(seed) as stagedir:
+                failure = extract_failure(seed, stagedir, name=name)
+                if failure is None:
+                    move_staged(stagedir)
+            os.remove(name)
+
+    if failure is not None:
+        if PULL_POLICY.should_retry(attempts, failure):
+            if verbose:
+                print("Pull of {0}, seed {1} failed ({2})".format(run, seed, failure))
+            PULL_POLICY.wait(attempts)
             return pullrun(name, seed, run, tmpdir, subfolder, attempts=attempts+1)
-        if DELETE_CORRUPTED:
+        if DELETE_CORRUPTED and failure in [util.FAIL_CORRUPT, util.FAIL_EMPTY]:
         # Hits if seed not found in any of the output files
             if verbose:
                 print("\033[91mDeleting {0}, seed {1}. Corrupted output\033[0m".format(run, seed))
             os.system("gfal-rm {0}".format(gridname))
-            return 1
-        return 1
+        return failure
     return 0
 
 
@@ -158,39 +316,59 @@ def print_run_stats(no_files_found, corrupt_no):
     print("    {2}Successful: {0:<5}\033[0m  {3}Corrupted: {1:<5}\033[0m".format(success_no,corrupt_no,suc_col,cor_col))
 
 
-def print_final_stats(start_time, tot_no_new_files, corrupt_no):
+def print_final_stats(start_time, tot_no_new_files, corrupt_no, failures=None):
     end_time = datetime.datetime.now()
     total_time = (end_time-start_time).__str__().split(".")[0]
     print("\033[92m{0:^80}\033[0m".format("Finalisation finished!"))
     print("Total time: {0} ".format(total_time))
     print("New files found: {0}".format(tot_no_new_files))
     print("Corrupted files: {0}".format(corrupt_no))
+    if failures:
+        for reason, no in sorted(failures.items()):
+            print("    {0:<10}: {1}".format(reason, no))
     print("Finish time: {0}".format(end_time.strftime('%H:%M:%S')))
 
 
-def pull_folder(foldername, folders=[], pool=None, rtag=None):
-    print("\033[94mPulling Folder: {0} \033[0m".format(foldername))
-    start_time = datetime.datetime.now()
+def list_folders(foldernames):
+    """ Long listing of all the grid folders in foldernames, all of them
+    queried at the same time. Returns the split lines of each listing """
+    cmds = []
+    for foldername in foldernames:
+        dirname = os.path.join(config.gfaldir, foldername)
+        dirname = ":".join([ls_protocol, dirname.split(":", 1)[-1]])
+        cmds.append(['gfal-ls', dirname , "-l", "-t", "9999999" ])
 
-    dirname = os.path.join(config.gfaldir, foldername)
-    dirname = ":".join([ls_protocol, dirname.split(":", 1)[-1]])
+    listings = []
+    for cmd_output in util.getOutputCall_many(cmds):
+        output = []
+        for x in str(cmd_output).split("\n"):
+            line = x.split()
+            if len(line)>0:
+                output.append(line)
+        listings.append(output)
+    return listings
 
-    cmd = ['gfal-ls', dirname , "-l", "-t", "9999999" ]
 
-    cmd_output = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-    output = []
-    for x in str(cmd_output).split("\n"):
-        line = x.split()
-        if len(line)>0:
-            output.append(line)
+def pull_folder(foldername, folders=[], pool=None, rtag=None, output=None):
+    print("\033[94mPulling Folder: {0} \033[0m".format(foldername))
+    start_time = datetime.datetime.now()
+
+    if output is None:
+        output = list_folders([foldername])[0]
 
     currentdir = os.getcwd()
 
-    output_files = set([x[-1] for x in output if x[0][0] != "d"])
     output_folders = set([x[-1] for x in output if x[0][0] == "d"])
+    # Parse the listing only once, and compare it with the one from the last
+    # finalise so that only new or modified files need to be considered
+    index = build_index(output)
+    index_file = get_index_file(currentdir, rtag)
+    old_index = load_index(index_file)
+    new_index = dict(old_index)
 
     tot_no_new_files = 0
     tot_no_corrupted_files = 0
+    failures = Counter()
     use_list = []
     for runcard in rc.dictCard:
         if type(rc.dictCard[runcard]) == str:
@@ -214,24 +392,30 @@ def pull_folder(foldername, folders=[], pool=None, rtag=None):
         dirtag = runcard + "-" + tag
         runcard_name_no_seed = "output{0}-".format(dirtag)
 
-        output_file_names,lfn_seeds = [],[]
-        for i in output_files:
-            if runcard_name_no_seed in i:
-                lfn_seeds.append(tarfile_regex.search(i).group(1))
-                output_file_names.append(i)
-
-        if not output_file_names: # Shortcircuit logfile check if nothing in lfn
+        remote_files = index.get(dirtag, {})
+        old_files = old_index.get(dirtag, {})
+        manifest_file = os.path.join(currentdir, get_output_dir_name(dirtag, rtag), "log", MANIFEST_FILE)
+        if not os.path.isfile(manifest_file):
+            # The local output (or its manifest) is gone, so the index says
+            # nothing about what is here: check every seed again
+            old_files = {}
+        changed_seeds = [seed for seed, entry in remote_files.items()
+                         if old_files.get(seed) != entry]
+
+        if not changed_seeds: # Shortcircuit logfile check if nothing new in lfn
             print_no_files_found(0)
             continue
 
-        # Makes the second runcard slightly quicker by removing matched files :)
-        output_files = output_files.difference(set(output_file_names))
-
-        logseeds, targetdir = createdirs(currentdir, dirtag, rtag)
-        pull_seeds = set(lfn_seeds).difference(logseeds)
+        manifest, targetdir = createdirs(currentdir, dirtag, rtag, remote_files)
+        # New seeds, or seeds whose remote file changed since they were pulled
+        pull_seeds = sorted(seed for seed in changed_seeds
+                            if manifest.get(seed) != remote_files[seed][1:])
+        modified_no = len([seed for seed in pull_seeds if seed in manifest])
 
         no_files_found = len(pull_seeds)
         print_no_files_found(no_files_found)
+        if modified_no > 0:
+            print("    {0} of them modified since they were last pulled".format(modified_no))
 
         if no_files_found>0:
             tot_no_new_files += no_files_found
@@ -241,15 +425,30 @@ def pull_folder(foldername, folders=[], pool=None, rtag=None):
                                                        it.repeat(runcard), 
                                                        it.repeat(rtag)),
                                    chunksize=1)
-            corrupt_no = sum(results)
+            failures.update(result for result in results if result)
+            corrupt_no = len([result for result in results if result])
             tot_no_corrupted_files += corrupt_no
             print_run_stats(no_files_found, corrupt_no)
+            pulled = {seed: remote_files[seed][1:] for seed, result
+                      in zip(pull_seeds, results) if result == 0}
+            append_manifest(os.path.join(targetdir, "log"), pulled)
+            manifest.update(pulled)
+
+        # Only remember files which are already here, so that failed pulls are retried
+        new_index[dirtag] = {seed: entry for seed, entry in remote_files.items()
+                             if manifest.get(seed) == entry[1:]}
+
+    save_index(index_file, new_index)
 
-    print_final_stats(start_time,tot_no_new_files,tot_no_corrupted_files)
+    print_final_stats(start_time,tot_no_new_files,tot_no_corrupted_files, failures)
     if RECURSIVE:
-        for output_folder in output_folders:
-            if any([tag==output_folder for tag in folders]):
-                pull_folder(os.path.join(foldername, output_folder), pool=pool, rtag=output_folder)
+        subfolders = [output_folder for output_folder in output_folders
+                      if any([tag==output_folder for tag in folders])]
+        # List all subfolders at once rather than one by one
+        listings = list_folders([os.path.join(foldername, i) for i in subfolders])
+        for output_folder, listing in zip(subfolders, listings):
+            pull_folder(os.path.join(foldername, output_folder), pool=pool,
+                        rtag=output_folder, output=listing)
 
 
 def do_finalise(*args, **kwargs):
@@ -66,6 +66,17 @@ template_attributes = [i for i in template_namespace if not
 template_attributes = [i for i in template_namespace if not
                        isinstance(getattr(template, i),ModuleType)]
 
+# Settings added to the template after most headers were written: the
+# template value is used for any of them the header doesn't set
+template_defaults = ["arcsub_batch_size", "ce_submission_list", "arcstat_batch_size",
+                     "stats_cache_ttl", "max_concurrent_commands", "grid_listing_ttl",
+                     "protocol_cache", "protocol_cache_window", "pass_protocols",
+                     "init_tar_processes", "init_upload_threads", "shared_executable",
+                     "deterministic_tars", "socket_fanout", "relay_hosts", "socket_timeout"]
+for i in template_defaults:
+    if not hasattr(head, i):
+        setattr(head, i, getattr(template, i))
+
 for temp_attr in template_attributes:
     logger.debug("{0:20}: {1}".format(temp_attr,getattr(head,temp_attr)))
 
@@ -9,6 +9,9 @@ def management_routine(backend, args):
     if args.list_disabled:
         backend.set_list_disabled()
 
+    if args.force_refresh:
+        backend.set_force_refresh()
+
     if args.get_data and pyHepGrid.src.header.finalisation_script:
         backend.get_data(0, custom_get=finalisation_script)
         exit(0)
@@ -44,6 +47,9 @@ def management_routine(backend, args):
 
     no_ids = len(id_list)
 
+    if args.stats or args.info or args.infoVerbose:
+        backend.prepare_stats(id_list)
+
     if args.get_grid_stdout:
         # if no_ids > 1:
         #     import pyHepGrid.src.header as header
@@ -8,9 +8,23 @@ This should be fixed in future. The main functions required are:
 init_production()
 init_warmup()
 """
+from concurrent.futures import ThreadPoolExecutor
 from pyHepGrid.src.header import logger, local_run_directory, grid_warmup_dir
+import pyHepGrid.src.header as header
+import pyHepGrid.src.utilities as util
+import multiprocessing as mp
 import sys
 import os
+import time
+
+
+def _tar_runcard(tar_job):
+    """ Tars up the files of a single runcard. Returns the runcard and the
+    time it took """
+    runcard, tarfile, files = tar_job
+    start = time.time()
+    util.TarWrap().tarFiles(files, tarfile)
+    return runcard, tarfile, time.time()-start
 
 
 class ProgramInterface(object):
@@ -103,6 +117,84 @@ class ProgramInterface(object):
                     self.gridw.delete(filename, grid_output_dir)
             logger.info("Output check complete")
 
+    def shared_executable_name(self, executable, digest):
+        # This function must always be the same as the one in the runfile
+        return "{0}-{1}.tar.gz".format(executable, digest)
+
+    def _send_shared_executable(self, executable, grid_dir):
+        """ Uploads executable to grid_dir under its sha256, unless an
+        identical one is already there, so that it can be shared by every
+        runcard. Returns the name of the local file pointing the runfile to
+        it, to be tarred up instead of the executable """
+        digest = util.file_sha256(executable)
+        tarfile = self.shared_executable_name(executable, digest)
+        if self.gridw.checkForThis(tarfile, grid_dir):
+            logger.info("Executable {0} already in GFAL {1}/".format(tarfile, grid_dir))
+        else:
+            self.tarw.tarFiles([executable], tarfile)
+            self._send_tarfile(tarfile, grid_dir)
+        pointer = "{0}.sha256".format(executable)
+        with open(pointer, "w") as pointer_file:
+            pointer_file.write(digest)
+        return pointer
+
+    def _send_tarfile(self, tarfile, grid_dir, interactive=True):
+        """ Replaces tarfile in grid_dir with the local one, which is then
+        removed. Returns the time it took. If not interactive, failed sends
+        keep the local tarfile and return None instead of asking what to do """
+        start = time.time()
+        if self.gridw.is_unchanged(tarfile, grid_dir):
+            logger.info("{0} in GFAL {1}/ is already up to date".format(tarfile, grid_dir))
+            os.remove(tarfile)
+            return time.time()-start
+        if self.gridw.checkForThis(tarfile, grid_dir):
+            logger.info("Removing old version of {0} from Grid Storage".format(tarfile))
+            self.gridw.delete(tarfile, grid_dir)
+        logger.info("Sending {0} to GFAL {1}/".format(tarfile, grid_dir))
+        if self.gridw.send(tarfile, grid_dir, shell=True, interactive=interactive) != 0 and not interactive:
+            return None
+        os.remove(tarfile)
+        return time.time()-start
+
+    def _tar_and_send_many(self, tar_jobs, grid_dir):
+        """ Tars up and sends to grid_dir the files of many runcards at once.
+        tar_jobs is a list of (runcard, tarfile, files). Tarfiles are made
+        in a process pool and each one is sent as soon as it is ready, with at
+        most header.init_upload_threads transfers at the same time """
+        if not tar_jobs:
+            return
+        start = time.time()
+        # List grid_dir once before the uploads share the cached listing
+        self.gridw.get_dir_contents(grid_dir)
+        tar_times, send_times = {}, {}
+        no_processes = min(len(tar_jobs), max(header.init_tar_processes, 1))
+        pool = mp.Pool(no_processes)
+        try:
+            with ThreadPoolExecutor(max_workers=max(header.init_upload_threads, 1)) as uploads:
+                futures = {}
+                for runcard, tarfile, tar_time in pool.imap_unordered(_tar_runcard, tar_jobs):
+                    tar_times[runcard] = tar_time
+                    futures[runcard] = uploads.submit(self._send_tarfile, tarfile, grid_dir,
+                                                      interactive=False)
+                for runcard, future in futures.items():
+                    send_times[runcard] = future.result()
+        finally:
+            pool.close()
+            pool.join()
+
+        # The uploads can't ask what to do when they fail, as they run at the
+        # same time. Try the failed ones again one by one, so they can
+        for runcard, tarfile, files in tar_jobs:
+            if send_times[runcard] is None:
+                logger.warning("Sending {0} again".format(tarfile))
+                send_times[runcard] = self._send_tarfile(tarfile, grid_dir)
+
+        logger.info("Initialisation times:")
+        for runcard, tarfile, files in tar_jobs:
+            logger.info("  {0:40} tar: {1:7.1f}s  send: {2:7.1f}s".format(
+                runcard, tar_times[runcard], send_times[runcard]))
+        logger.info("  {0:40} {1:.1f}s".format("Total", time.time()-start))
+
     # helper functions
     def _press_yes_to_continue(self, msg, error=None, fallback=None):
         """ Press y to continue
@@ -269,10 +269,12 @@ class NNLOJET(ProgramInterface):
             logger.critical("Could not find executable at {0}".format(path_to_exe_full))
         copy(path_to_exe_full, os.getcwd())
         files = [executable_exe]
+        if header.shared_executable:
+            files = [self._send_shared_executable(executable_exe, header.grid_input_dir)]
+        tar_jobs = []
         for idx, i in enumerate(rncards):
             logger.info("Initialising {0} [{1}/{2}]".format(i, idx+1, len(rncards)))
             local = False
-            warmupFiles = []
             # Check whether warmup/production is active in the runcard
             runcard_file = os.path.join(runFol, i)
 
@@ -300,18 +302,12 @@ class NNLOJET(ProgramInterface):
                     files += warmup_files
                     logger.info("Warmup files found: {0}".format(" ".join(i for i in warmup_files)))
 
-            self.tarw.tarFiles(files + [i], tarfile)
-            if self.gridw.checkForThis(tarfile, header.grid_input_dir): # Could we cache this? Just to speed up ini
-                logger.info("Removing old version of {0} from Grid Storage".format(tarfile))
-                self.gridw.delete(tarfile, header.grid_input_dir)
-            logger.info("Sending {0} to gfal {1}/".format(tarfile, header.grid_input_dir))
-            self.gridw.send(tarfile, header.grid_input_dir, shell=True)
-            if not local:
-                for j in warmupFiles:
-                    os.remove(j)
+            tar_jobs.append((i, tarfile, files + [i]))
+
+        self._tar_and_send_many(tar_jobs, header.grid_input_dir)
+        for i, tarfile, tar_files in tar_jobs:
             os.remove(i)
-            os.remove(tarfile)
-        os.remove(executable_exe)
+        util.spCall(["rm", "-f", executable_exe, "{0}.sha256".format(executable_exe)])
         os.chdir(origdir)
 
     def init_single_local_production(self, runcard, tag, provided_warmup=False):
@@ -381,6 +377,10 @@ class NNLOJET(ProgramInterface):
             logger.critical("Could not find executable at {0}".format(path_to_exe_full))
         copy(path_to_exe_full, os.getcwd())
         files = [executable_exe]
+        if header.shared_executable:
+            files = [self._send_shared_executable(executable_exe, header.grid_input_dir)]
+        tar_jobs = []
+        cleanup = []
         for idx, i in enumerate(rncards):
             logger.info("Initialising {0} [{1}/{2}]".format(i, idx+1, len(rncards)))
             local = False
@@ -405,17 +405,15 @@ class NNLOJET(ProgramInterface):
             else:
                 logger.info("Retrieving warmup file from grid")
                 warmupFiles = self._bring_warmup_files(i, rname, shell=True, multichannel=multichannel)
-            self.tarw.tarFiles(files + [i] + warmupFiles, tarfile)
-            if self.gridw.checkForThis(tarfile, header.grid_input_dir):
-                logger.info("Removing old version of {0} from Grid Storage".format(tarfile))
-                self.gridw.delete(tarfile, header.grid_input_dir)
-            logger.info("Sending {0} to GFAL {1}/".format(tarfile, header.grid_input_dir))
-            self.gridw.send(tarfile, header.grid_input_dir, shell=True)
+            tar_jobs.append((i, tarfile, files + [i] + warmupFiles))
             if local:
-                util.spCall(["rm", i, tarfile])
+                cleanup += [i]
             else:
-                util.spCall(["rm", i, tarfile] + warmupFiles)
-        os.remove(executable_exe)
+                cleanup += [i] + warmupFiles
+
+        self._tar_and_send_many(tar_jobs, header.grid_input_dir)
+        util.spCall(["rm"] + sorted(set(cleanup)))
+        util.spCall(["rm", "-f", executable_exe, "{0}.sha256".format(executable_exe)])
         os.chdir(origdir)
 
     def _get_local_warmup_name(self, matchname, provided_warmup):
@@ -587,12 +585,7 @@ class HEJ(ProgramInterface):
 
             # tar up & send to grid storage
             self.tarw.tarFiles(warmupFiles+runFiles, tarfile)
-
-            if self.gridw.checkForThis(tarfile, grid_input_dir):
-                logger.info("Removing old version of {0} from Grid Storage".format(tarfile))
-                self.gridw.delete(tarfile, grid_input_dir)
-            logger.info("Sending {0} to {1}".format(tarfile, grid_input_dir))
-            self.gridw.send(tarfile, grid_input_dir, shell=True)
+            self._send_tarfile(tarfile, grid_input_dir)
 
         # clean up afterwards
         os.chdir(origdir)
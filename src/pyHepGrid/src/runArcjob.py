@@ -38,6 +38,21 @@ class RunArc(Backend):
             header.logger.warning("Arguments: {}".format(input_args))
             raise Exception("Type of input arguments: {} not regocnised in ARC ._format_args".format(type(input_args)))
 
+    def _write_XRSL_job(self, f, dictData):
+        """ Writes the description of a single job (template + dictData)
+        into the open file f
+        """
+        for i in self.templ:
+            f.write(i)
+            f.write('\n')
+        for key in dictData:
+            f.write("(" + key)
+            argument_value = dictData[key].strip()
+            if argument_value[0] == "\"" and argument_value[-1] == "\"":
+                f.write(" = {})\n".format(argument_value))
+            else:
+                f.write(" = \"{}\")\n".format(argument_value))
+
     def _write_XRSL(self, dictData, filename = None):
         """ Writes a unique XRSL file
         which instructs the arc job to run
@@ -45,24 +60,28 @@ class RunArc(Backend):
         if not filename:
             filename = util.unique_filename()
         with open(filename, 'w') as f:
-            for i in self.templ:
-                f.write(i)
-                f.write('\n')
-            for key in dictData:
-                f.write("(" + key)
-                argument_value = dictData[key].strip()
-                if argument_value[0] == "\"" and argument_value[-1] == "\"":
-                    f.write(" = {})\n".format(argument_value))
-                else:
-                    f.write(" = \"{}\")\n".format(argument_value))
+            self._write_XRSL_job(f, dictData)
         return filename
 
-    def _run_XRSL(self, filename, test = False):
-        """ Sends XRSL to the queue defined in header
+    def _write_XRSL_batch(self, list_dictData, filename = None):
+        """ Writes a multi-job XRSL file, with one job per element of
+        list_dictData, so that all of them can be sent with a single arcsub
+        """
+        if not filename:
+            filename = util.unique_filename()
+        with open(filename, 'w') as f:
+            f.write("+\n")
+            for dictData in list_dictData:
+                f.write("(")
+                self._write_XRSL_job(f, dictData)
+                f.write(")\n")
+        return filename
+
+    def _get_submission_ce(self, test = False):
+        """ Returns the computing element to submit to
         If test = True, use test queue
         """
         import random
-        from pyHepGrid.src.header import arc_direct
         from pyHepGrid.src.header import split_dur_ce
         if test:
             from pyHepGrid.src.header import ce_test as ce
@@ -70,16 +89,97 @@ class RunArc(Backend):
             from pyHepGrid.src.header import ce_base as ce
             if split_dur_ce and ".dur.scotgrid.ac.uk" in ce: # Randomise ce at submission time to reduce load
                 ce = random.choice(["ce1.dur.scotgrid.ac.uk","ce2.dur.scotgrid.ac.uk"])
+        return ce
 
+    def _get_submission_ces(self, test = False):
+        """ Returns the list of computing elements production batches are
+        spread over. If test = True, use test queue
+        """
+        from pyHepGrid.src.header import split_dur_ce, ce_submission_list
+        if test:
+            from pyHepGrid.src.header import ce_test
+            return [ce_test]
+        if ce_submission_list:
+            return list(ce_submission_list)
+        from pyHepGrid.src.header import ce_base
+        if split_dur_ce and ".dur.scotgrid.ac.uk" in ce_base:
+            return ["ce1.dur.scotgrid.ac.uk","ce2.dur.scotgrid.ac.uk"]
+        return [ce_base]
+
+    def _arcsub(self, filename, ce):
+        """ Sends XRSL file to the computing element ce
+        and returns the raw output of arcsub
+        """
+        from pyHepGrid.src.header import arc_direct
         cmd = "arcsub -c {0} {1} -j {2}".format(ce, filename, self.arcbd)
         # Can only use direct in Durham. Otherwise fails!
         # Speeds up submission (according to Stephen)
         if arc_direct and ".dur.scotgrid.ac.uk" in ce:
             cmd += " -S org.nordugrid.gridftpjob --direct "
-        output = util.getOutputCall(cmd.split())
+        return util.getOutputCall(cmd.split())
+
+    def _parse_jobids(self, output):
+        """ Returns the list of jobids, in submission order, found in
+        the output of arcsub
+        """
+        return [line.split("jobid:")[-1].strip() for line in output.split("\n")
+                if "jobid:" in line]
+
+    def _parse_submission(self, output):
+        """ Returns the result of every job description sent, in submission
+        order, from the output of arcsub: its jobid or None if it failed
+        """
+        results = []
+        for line in output.split("\n"):
+            if "jobid:" in line:
+                results.append(line.split("jobid:")[-1].strip())
+            elif "submission failed" in line.lower() or "failed to submit" in line.lower():
+                results.append(None)
+        return results
+
+    def _run_XRSL(self, filename, test = False):
+        """ Sends XRSL to the queue defined in header
+        If test = True, use test queue
+        """
+        output = self._arcsub(filename, self._get_submission_ce(test))
         jobid = output.split("jobid:")[-1].rstrip().strip()
         return jobid
 
+    def _run_XRSL_batch(self, filename, ce, seed_batch):
+        """ Sends a multi-job XRSL (one job per seed in seed_batch) to the
+        computing element ce and returns the jobid of every seed, None for
+        the seeds whose job was not submitted
+        """
+        output = self._arcsub(filename, ce)
+        results = self._parse_submission(output)
+        if len(results) != len(seed_batch):
+            # Can't tell which seeds failed, so the batch can't be stored
+            jobids = self._parse_jobids(output)
+            header.logger.error("Only {0} of {1} jobs submitted to {2} for seeds {3}-{4}".format(
+                len(jobids), len(seed_batch), ce, seed_batch[0], seed_batch[-1]))
+            if jobids:
+                header.logger.error("Untracked jobids (kill them with arckill): {0}".format(" ".join(jobids)))
+            raise Exception("Batch submission to {0} failed".format(ce))
+        failed = [seed for seed, jobid in zip(seed_batch, results) if jobid is None]
+        if failed:
+            header.logger.error("Jobs for seeds {0} not submitted to {1}".format(
+                " ".join(str(seed) for seed in failed), ce))
+        return results
+
+    def _submit_production_batch(self, r, rname, seed_batch, ce):
+        """ Writes the XRSL for the seeds in seed_batch and sends it to ce """
+        from pyHepGrid.src.header import jobName
+        batch_data = []
+        for seed in seed_batch:
+            arguments = self._get_prod_args(r, rname, seed)
+            batch_data.append({'arguments'   : arguments,
+                               'jobName'     : jobName,
+                               'count'       : str(1),
+                               'countpernode': str(1),})
+        xrslfile = self._write_XRSL_batch(batch_data)
+        header.logger.debug(" > Path of xrsl file: {0}".format(xrslfile))
+        return self._run_XRSL_batch(xrslfile, ce, seed_batch)
+
     # Runs for ARC
     def run_wrap_warmup(self, test = None, expandedCard = None):
         """ Wrapper function. It assumes the initialisation stage has already happend
@@ -127,12 +227,17 @@ class RunArc(Backend):
         header.logger.info("Runcards selected: {0}".format(" ".join(r for r in rncards)))
         port = header.port
         for r in rncards:
+            last_port = port
             if n_sockets > 1:
                 # Automagically activates the socket and finds the best port for it!
                 port = sapi.fire_up_socket_server(header.server_host, port, n_sockets,
                                                   header.wait_time, header.socket_exe,
-                                                  tag="{0}-{1}".format(r,dCards[r]))
+                                                  tag="{0}-{1}".format(r,dCards[r]),
+                                                  timeout=header.socket_timeout)
                 job_type = "Socket={}".format(port)
+                last_port = port
+                if header.socket_fanout and n_sockets > header.socket_fanout:
+                    last_port = self._fire_up_relays(r, dCards[r], port, n_sockets)
 
             # Check whether this run has something on the gridStorage
             self.check_for_existing_warmup(r, dCards[r])
@@ -162,18 +267,17 @@ class RunArc(Backend):
             else:
                 pathfolder = "None"
             # Create database entry
-            dataDict = {'jobid'     : ' '.join(jobids),
-                        'date'      : str(datetime.now()),
+            dataDict = {'date'      : str(datetime.now()),
                         'pathfolder': pathfolder,
                         'runcard'   : r,
                         'runfolder' : dCards[r],
                         'jobtype'   : job_type,
                         'status'    : "active",}
             if len(jobids) > 0:
-                self.dbase.insert_data(self.table, dataDict)
+                self._insert_run(dataDict, jobids)
             else:
                 header.logger.critical("No jobids returned, no database entry inserted for submission: {0} {1}".format(r, dCards[r]))
-            port += 1
+            port = last_port + 1
             if keyquit is not None:
                 raise keyquit
 
@@ -182,65 +286,119 @@ class RunArc(Backend):
             Writes XRSL file with the appropiate information and send a producrun
             number of jobs to the arc queue
         """
-        from pyHepGrid.src.header import baseSeed, producRun, jobName, lhapdf_grid_loc, lhapdf_loc, executable_exe
+        from pyHepGrid.src.header import baseSeed, producRun, arcsub_batch_size
 
         # runcard names (keys)
         # dCards, dictionary of { 'runcard' : 'name' }
         rncards, dCards = util.expandCard()
         self.runfolder = header.runcardDir
-        job_type = "Production"
+        seeds = list(range(baseSeed, baseSeed + producRun))
+        seed_batches = list(util.batch_gen(seeds, max(arcsub_batch_size, 1)))
+        ces = self._get_submission_ces(test)
 
         header.logger.info("Runcards selected: {0}".format(" ".join(r for r in rncards)))
         for r in rncards:
-            joblist = []
             # Check whether this run has something on the gridStorage
             self.check_for_existing_output(r, dCards[r])
-            # use the same unique name for all seeds since
-            # we cannot multiprocess the arc submission
-            xrslfile = None
             keyquit = None
 
             # Sanity check for test queue
             if test and producRun > 5:
                 self._press_yes_to_continue("  \033[93m WARNING:\033[0m About to submit a large number ({0}) of jobs to the test queue.".format(producRun))
 
-            try:
-                for seed in range(baseSeed, baseSeed + producRun):
-                    arguments = self._get_prod_args(r, dCards[r], seed)
-                    dictData = {'arguments'   : arguments,
-                                'jobName'     : jobName,
-                                'count'       : str(1),
-                                'countpernode': str(1),}
-                    xrslfile = self._write_XRSL(dictData, filename = xrslfile)
-                    if(seed == baseSeed):
-                        header.logger.debug(" > Path of xrsl file: {0}".format(xrslfile))
-                # Run the file
-                    jobid = self._run_XRSL(xrslfile, test=test)
-                    joblist.append(jobid)
-            except Exception as interrupt:
+            # One XRSL per batch, batches are sent round-robin to the computing elements
+            batch_ces = [ces[idx % len(ces)] for idx in range(len(seed_batches))]
+            header.logger.info("Submitting {0} jobs in {1} batches to {2}".format(
+                producRun, len(seed_batches), ", ".join(ces)))
+
+            # One at a time: every arcsub writes to the same ARC job list
+            batch_jobids = len(seed_batches)*[None]
+            no_submitted = 0
+            for idx, (seed_batch, ce) in enumerate(zip(seed_batches, batch_ces)):
+                try:
+                    batch_jobids[idx] = self._submit_production_batch(r, dCards[r], seed_batch, ce)
+                except KeyboardInterrupt as interrupt:
+                    keyquit = interrupt
+                    break
+                except Exception as e:
+                    header.logger.error("Batch {0} [{1}]: {2}".format(idx+1, ce, e))
+                    keyquit = e
+                    continue
+                if None in batch_jobids[idx]:
+                    keyquit = Exception("Batch {0} [{1}] partially submitted".format(idx+1, ce))
+                no_submitted += len(batch_jobids[idx]) - batch_jobids[idx].count(None)
+                header.logger.info("Submitted {0}/{1} jobs".format(no_submitted, producRun))
+            if keyquit is not None:
                 print("\n")
                 header.logger.error("Submission error encountered. Inserting all successful submissions to database")
-                keyquit = interrupt
-            # Create daily path
-            pathfolder = util.generatePath(warmup=False)
-            # Create database entry
-            jobStr = ' '.join(joblist)
-            dataDict = {'jobid'     : jobStr,
-                        'date'      : str(datetime.now()),
-                        'pathfolder': pathfolder,
-                        'runcard'   : r,
-                        'jobtype'   : job_type,
-                        'runfolder' : dCards[r],
-                        'iseed'     : str(baseSeed),
-                        'no_runs'   : str(producRun),
-                        'status'    : "active",}
-            if len(joblist) > 0:
-                self.dbase.insert_data(self.table, dataDict)
-            else:
-                header.logger.critical("No jobids returned, no database entry inserted for submission: {0} {1}".format(r, dCards[r]))
+
+            self._insert_production_entries(r, dCards[r], seed_batches, batch_jobids, batch_ces)
             if keyquit is not None:
                 raise keyquit
 
+    def _fire_up_relays(self, runcard, runtag, port, n_sockets):
+        """ Starts enough relay socket servers for at most header.socket_fanout
+        jobs each, forwarding to the main server at port. The main server
+        spreads the jobs over them once they salute it, so that it only has to
+        handle the relays each iteration. Returns the last port used """
+        from math import ceil
+        hosts = header.relay_hosts or [header.server_host]
+        upstream = "{0}:{1}".format(header.server_host, port)
+        n_relays = int(ceil(n_sockets/float(header.socket_fanout)))
+        relay_port = port
+        for i_relay in range(n_relays):
+            relay_port = sapi.fire_up_socket_server(hosts[i_relay % len(hosts)], relay_port+1, 0,
+                                                    None, header.socket_exe,
+                                                    tag="{0}-{1}-relay{2}".format(runcard, runtag, i_relay),
+                                                    relay=upstream, timeout=header.socket_timeout)
+        header.logger.info("Started {0} relay socket servers for {1}".format(n_relays, upstream))
+        return relay_port
+
+    def _insert_production_entries(self, r, rname, seed_batches, batch_jobids, batch_ces):
+        """ Inserts one database entry for each run of consecutive successfully
+        submitted seeds, so that every entry keeps a contiguous range of seeds starting at iseed.
+        The seed and computing element of every jobid are stored in its subjob row
+        """
+        segments = []
+        current = None
+        for seed_batch, jobids, ce in zip(seed_batches, batch_jobids, batch_ces):
+            if jobids is None:
+                jobids = len(seed_batch)*[None]
+            for seed, jobid in zip(seed_batch, jobids):
+                if jobid is None:
+                    current = None
+                    continue
+                if current is None:
+                    current = {"iseed": seed, "seeds": [], "jobids": [], "ces": []}
+                    segments.append(current)
+                current["seeds"].append(seed)
+                current["jobids"].append(jobid)
+                current["ces"].append(ce)
+
+        if not segments:
+            header.logger.critical("No jobids returned, no database entry inserted for submission: {0} {1}".format(r, rname))
+        if len(segments) > 1:
+            header.logger.warning("Some jobs failed, the submission is split into {0} database entries".format(len(segments)))
+
+        # Create daily path
+        pathfolder = util.generatePath(warmup=False)
+        with self.dbase.transaction():
+            for segment in segments:
+                for ce in sorted(set(segment["ces"])):
+                    header.logger.info("{0} jobs sent to {1}".format(segment["ces"].count(ce), ce))
+                # Create database entry
+                dataDict = {'date'      : str(datetime.now()),
+                            'pathfolder': pathfolder,
+                            'runcard'   : r,
+                            'jobtype'   : "Production",
+                            'runfolder' : rname,
+                            'iseed'     : str(segment["iseed"]),
+                            'no_runs'   : str(len(segment["jobids"])),
+                            'queue'     : ' '.join(segment["ces"]),
+                            'status'    : "active",}
+                self._insert_run(dataDict, segment["jobids"], seeds=segment["seeds"],
+                                 ces=segment["ces"])
+
 def runWrapper(runcard, test = None, expandedCard = None):
     header.logger.info("Running arc job for {0}".format(runcard))
     arc = RunArc(arcscript=header.ARCSCRIPTDEFAULT)
@@ -91,10 +91,8 @@ class RunDirac(Backend):
                 seed_start = seed_start + no_seeds
             # Create daily path
             pathfolder = util.generatePath(False)
-            # Create database entr
-            jobStr   = ' '.join(joblist)
-            dataDict = {'jobid'     : jobStr,
-                        'date'      : str(datetime.now()),
+            # Create database entry
+            dataDict = {'date'      : str(datetime.now()),
                         'pathfolder': pathfolder,
                         'runcard'   : r,
                         'runfolder' : dCards[r],
@@ -102,7 +100,8 @@ class RunDirac(Backend):
                         'no_runs'   : str(producRun),
                         'jobtype'   : "Production",
                         'status'    : "active",}
-            self.dbase.insert_data(self.table, dataDict)
+            seeds = list(range(baseSeed, baseSeed + len(joblist)))
+            self._insert_run(dataDict, joblist, seeds=seeds)
 
 
 def runWrapper(runcard, test = None):
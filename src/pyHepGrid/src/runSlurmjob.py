@@ -151,7 +151,8 @@ class RunSlurm(Backend):
                 port = sapi.fire_up_socket_server(header.server_host, port, n_sockets,
                                                   None, header.socket_exe,
                                                   tag="{0}-{1}".format(r,dCards[r]),
-                                                  tmuxloc=header.tmux_location)
+                                                  tmuxloc=header.tmux_location,
+                                                  timeout=header.socket_timeout)
                 job_type = "Socket={}".format(port)
             # TODO check if warmup exists? nah
 
@@ -173,8 +174,7 @@ class RunSlurm(Backend):
             jobids.append(jobid)
 
             # Create database entry
-            dataDict = {'jobid'     : ' '.join(jobids),
-                        'no_runs'   : str(n_sockets),
+            dataDict = {'no_runs'   : str(n_sockets),
                         'date'      : str(datetime.now()),
                         'pathfolder': arguments["runcard_dir"],
                         'runcard'   : r,
@@ -183,7 +183,7 @@ class RunSlurm(Backend):
                         'queue'     : str(runqueue),
                         'status'    : "active",}
             if len(jobids) > 0:
-                self.dbase.insert_data(self.table, dataDict)
+                self._insert_run(dataDict, jobids, ces=[str(runqueue)])
             else:
                 header.logger.critical("No jobids returned, no database entry inserted for submission: {0} {1}".format(r, dCards[r]))
             port += 1
@@ -220,8 +220,7 @@ class RunSlurm(Backend):
             jobid, runqueue = self._run_SLURM(slurmfile, arguments, queue, test=test)
             jobids.append(jobid)
             # Create database entry
-            dataDict = {'jobid'     : ' '.join(jobids),
-                        'date'      : str(datetime.now()),
+            dataDict = {'date'      : str(datetime.now()),
                         'pathfolder': arguments["runcard_dir"],
                         'runcard'   : r,
                         'runfolder' : dCards[r],
@@ -231,7 +230,7 @@ class RunSlurm(Backend):
                         'no_runs'   : str(producRun),
                         'status'    : "active",}
             if len(jobids) > 0:
-                self.dbase.insert_data(self.table, dataDict)
+                self._insert_run(dataDict, jobids, ces=[str(runqueue)])
             else:
                 header.logger.critical("No jobids returned, no database entry inserted for submission: {0} {1}".format(r, dCards[r]))
 
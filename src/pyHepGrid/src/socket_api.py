@@ -104,12 +104,17 @@ def check_port_blocked(host, port):
 
     return blocked
 
-def fire_up_socket_server(host, port, n_sockets, wait_time = "18000", socket_exe = "/mt/home/jmartinez/Gangaless_new/src/socket_server.py",tag="", tmuxloc = "tmux"):
+def fire_up_socket_server(host, port, n_sockets, wait_time = "18000", socket_exe = "/mt/home/jmartinez/Gangaless_new/src/socket_server.py",tag="", tmuxloc = "tmux",
+                          relay = None, timeout = None):
     """
     Fires up the vegas socket server inside a tmux terminal
     in the given 'host' for 'n_sockets' and with a 'wait_time' (s)
     'port' is the starting point, it won't fire up the server until
     finding one free
+    If 'relay' (host:port of the main server) is given, the server is a relay
+    which gets its jobs from the main server instead
+    If 'timeout' (s) is given, iterations go ahead without the jobs which
+    have not reported 'timeout' seconds after the first one
 
     On success return the free port
     """
@@ -128,6 +133,10 @@ def fire_up_socket_server(host, port, n_sockets, wait_time = "18000", socket_exe
         waitstr = "-w {0}".format(wait_time)
     cmd_server = "{0} -N {1} -p {2} {3} -l {4}".format(socket_exe, n_sockets, port,
                                                        waitstr, tms)
+    if relay is not None:
+        cmd_server += " --relay {0}".format(relay)
+    if timeout is not None:
+        cmd_server += " --timeout {0}".format(timeout)
     kill_session_cmd = tmux.get_kill_cmd()
     cmd = "{0} && {1}".format(cmd_server, kill_session_cmd)
     tmux.run_cmd(cmd)
@@ -3,6 +3,43 @@
 import socket
 import struct
 import datetime
+import operator
+import math
+import time
+import selectors
+from array import array
+from collections import Counter
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RELAY_CONNECT_TRIES = 60 # Seconds a relay keeps trying to reach the upstream server
+
+
+def add_arrays(total, partial):
+    """ Adds the array('d') partial into total in place. Uses numpy if
+    available, without copying either array. numpy is optional on the gridui:
+    without it this is a plain python loop, no faster than the old
+    element by element sum
+    """
+    if len(total) != len(partial):
+        raise Exception("Received arrays of different length!")
+    if numpy is not None:
+        total_np = numpy.frombuffer(total, dtype=numpy.float64)
+        numpy.add(total_np, numpy.frombuffer(partial, dtype=numpy.float64), out=total_np)
+    else:
+        total[:] = array('d', map(operator.add, total, partial))
+    return total
+
+def scale_array(total, factor):
+    """ Multiplies the array('d') total by factor in place """
+    if numpy is not None:
+        total_np = numpy.frombuffer(total, dtype=numpy.float64)
+        numpy.multiply(total_np, factor, out=total_np)
+    else:
+        total[:] = array('d', (value*factor for value in total))
+    return total
 
 class Generic_Socket:
     """
@@ -10,7 +47,7 @@ class Generic_Socket:
     https://docs.python.org/3.6/howto/sockets.html
     """
 
-    def __init__(self, sock=None, address=2*["UNK"], logger=None):
+    def __init__(self, sock=None, address=2*["UNK"], logger=None, buffer_size=None):
         self.double_size = 8
         """Create a IPv4 TCP socket
         """
@@ -20,6 +57,8 @@ class Generic_Socket:
         else:
             self.sock = sock
             self.address = address
+        if buffer_size:
+            self.set_buffer_size(buffer_size)
 
         if logger:
             self._info_print = logger.info
@@ -30,6 +69,14 @@ class Generic_Socket:
             self._debug_print = print
             self._critical_print = print
 
+    def set_buffer_size(self, buffer_size):
+        """ Sets the kernel send and receive buffers to buffer_size bytes.
+        Sockets accepted by a server inherit the buffers of the server.
+        Note setting them disables the automatic tuning done by Linux
+        """
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+
     def connect(self, host, port):
         """ Connects socket to given host-port
         """
@@ -63,27 +110,28 @@ class Generic_Socket:
         """ Receive any kind of binary data until it fullfills msg_len bytes of data
         Returns binary data received
         """
-        chunks = []
+        return bytes(self.receive_into(bytearray(msg_len), verbose = verbose))
+
+    def receive_into(self, buffer, verbose=None):
+        """ Receive binary data straight into a writable buffer (eg. an array)
+        until it is full
+        """
+        view = memoryview(buffer).cast('B')
         bytes_received = 0
-        while bytes_received < msg_len:
+        while bytes_received < len(view):
             if verbose:
                 self._info_print("Waiting for a connection")
-            chunk = self.sock.recv(min(msg_len - bytes_received, 2048))
-            if chunk == b'':
-                self._critical_print("Data up to now:")
-                self._critical_print(chunks)
+            nbytes = self.sock.recv_into(view[bytes_received:])
+            if nbytes == 0:
+                self._critical_print("Received {0} of {1} bytes".format(bytes_received, len(view)))
                 raise RuntimeError("socket connection broken")
-            chunks.append(chunk)
-            bytes_received = bytes_received + len(chunk)
-        return b''.join(chunks)
+            bytes_received += nbytes
+        return buffer
 
     def send_data(self, msg):
-        """ Sends binary data
+        """ Sends binary data (any bytes-like object, without copying it)
         """
-        total_sent = 0
-        while total_sent < len(msg):
-            sent = self.sock.send(msg)
-            total_sent += sent
+        self.sock.sendall(memoryview(msg).cast('B'))
 
     def get_host_by_address(self, host_addr):
         """ Given an ip address, get hostname
@@ -102,6 +150,169 @@ class Vegas_Socket(Generic_Socket):
     """ Extends Generic_Socket for its
     use with Vegas with sockets support
     """
+    # (host, port) of the server this one relays its jobs to, if any, and
+    # the host:port this relay registered with upstream
+    upstream = None
+    relay_name = None
+
+    def forward_upstream(self, integral_value):
+        """ Relay mode: sends the sum of the jobs of this relay upstream
+        as if it were a single job and returns the total sent back.
+        The array is preceded by the name of the relay, so that the upstream
+        server can tell relays apart even if they share a host
+        """
+        upstream = Vegas_Socket()
+        upstream.connect(*self.upstream)
+        name = self.relay_name.encode()
+        data = memoryview(integral_value).cast('B')
+        upstream.send_data(b"rly!" + len(name).to_bytes(4, byteorder="little") + name)
+        upstream.send_data(len(data).to_bytes(4, byteorder="little"))
+        upstream.send_data(data)
+        total = upstream.read_partial_integral(len(data))
+        upstream.close()
+        return total
+
+    def _forward_or_abandon(self, integral_value, job_sockets):
+        """ Relay mode: forwards integral_value upstream and returns the
+        total. If the upstream server drops this relay (or is gone), the jobs
+        of the relay can't carry on: their connections are closed, rather than
+        leaving them waiting for a total, and the relay exits """
+        try:
+            return self.forward_upstream(integral_value)
+        except (OSError, RuntimeError) as e:
+            self._critical_print(" > Upstream server dropped this relay ({0}). Closing the connections of its {1} jobs".format(
+                e, len(job_sockets)))
+            for job_socket in job_sockets:
+                job_socket.close()
+            exit(-1)
+
+    def forward_exit(self):
+        """ Relay mode: passes the exit code of the jobs upstream. The upstream
+        server may be gone already if another relay got there first
+        """
+        try:
+            upstream = Vegas_Socket()
+            upstream.connect(*self.upstream)
+            upstream.send_data(b"bye!")
+            upstream.close()
+        except OSError as e:
+            self._info_print(" > Could not pass exit code upstream ({0})".format(e))
+
+    # Straggler handling, only active with an iteration_timeout (s) and once
+    # the roster of jobs is known. Once the first job of an iteration reports,
+    # the others have iteration_timeout to do so. After that the iteration
+    # goes ahead as soon as a quorum (fraction) of the jobs has reported.
+    # Jobs are told apart by address only, so a late result from an address
+    # running several jobs could pass for a new one: those are always waited for
+    iteration_timeout = None
+    quorum = 0.5
+    rescale = False
+    evict = False
+    # Counter of the jobs expected from each job address (the IP of the job,
+    # or the name of the relay), once known
+    roster = None
+    # Counter of late results still to come for iterations that went ahead
+    # without them, per job address, and the last total sent out
+    stale = None
+    last_total = None
+
+    def _quorum_size(self, n_jobs):
+        return max(1, math.ceil(self.quorum*n_jobs))
+
+    def _remaining(self, deadline, reported, n_jobs):
+        """ Seconds left to wait for jobs this iteration, given the Counter of
+        job addresses which already reported: None for no limit and 0 once the
+        deadline has passed and there are enough jobs to go ahead
+        """
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            return remaining
+        shared = [address for address, count in self.roster.items()
+                  if count > 1 and reported[address] < count]
+        if shared:
+            if not self._waiting_for_shared:
+                self._info_print(" > Deadline passed, waiting for all the jobs of {0}: jobs sharing an address can't be told apart".format(
+                    ", ".join(shared)))
+                self._waiting_for_shared = True
+            return None
+        n_reported = sum(reported.values())
+        if n_reported >= self._quorum_size(n_jobs):
+            return 0
+        if not self._waiting_for_quorum:
+            self._info_print(" > Deadline passed with {0}/{1} jobs reported, waiting for a quorum of {2}".format(
+                n_reported, n_jobs, self._quorum_size(n_jobs)))
+            self._waiting_for_quorum = True
+        return None
+
+    def _admit(self, endpoint, reported):
+        """ Classifies a job which sent its partial integral this iteration
+        given the Counter of job addresses which already reported: "accept",
+        "stale" (a late result for an iteration that went ahead without it)
+        or "reject" (evicted)
+        """
+        address = endpoint.job
+        if self.iteration_timeout is None:
+            return "accept"
+        if self.stale and self.stale[address] > 0:
+            return "stale"
+        if self.roster is not None and reported[address] >= self.roster[address]:
+            return "reject"
+        return "accept"
+
+    def _turn_away(self, endpoint, admission, partial_value):
+        """ Deals with a job which is not part of this iteration. Late jobs
+        get the last total, so they can carry on, evicted ones are dropped
+        """
+        address = endpoint.job
+        if admission == "stale":
+            self.stale[address] -= 1
+            self._info_print(" > Late result from {0} for an earlier iteration, not added to this one".format(address))
+            if self.last_total is not None and len(self.last_total) == len(partial_value):
+                endpoint.sock.setblocking(True)
+                endpoint.send_total_integral(self.last_total)
+        else:
+            self._info_print(" > Turned away {0}, evicted from the run".format(address))
+        endpoint.close()
+
+    def _close_iteration(self, n_jobs, reported, integral_value, arrivals):
+        """ Logs the arrival times of the jobs and decides what to do about the
+        ones that missed the deadline, if any. Returns the integral to send back
+        """
+        n_reported = sum(reported.values())
+        if arrivals and self.iteration_timeout is not None:
+            last_address, last_arrival = arrivals[-1]
+            self._info_print("   Jobs reported between {0:.1f}s and {1:.1f}s (last: {2})".format(
+                arrivals[0][1], last_arrival, last_address))
+        if n_reported < n_jobs:
+            self._info_print(" > Going ahead with {0}/{1} jobs".format(n_reported, n_jobs))
+            if self.rescale:
+                scale_array(integral_value, n_jobs/n_reported)
+                self._info_print(" > Rescaled the total by {0}/{1}".format(n_jobs, n_reported))
+            else:
+                self._info_print(" > [WARNING] Degraded iteration, the total is missing {0} jobs".format(
+                    n_jobs - n_reported))
+            # Only addresses running a single job can be missing here
+            if self.stale is None:
+                self.stale = Counter()
+            for address, count in (self.roster - reported).items():
+                if self.evict:
+                    self._info_print(" > Evicted {0} job(s) from {1}".format(count, address))
+                    del self.roster[address]
+                else:
+                    self._info_print(" > Expecting {0} late job(s) from {1}".format(count, address))
+                    self.stale[address] += count
+        elif self.roster is None and self.iteration_timeout is not None:
+            self.roster = reported
+            self._info_print("   Jobs known, the deadline applies from the next iteration on")
+        return integral_value
+
+    def jobs_expected(self, n_jobs):
+        """ Number of jobs for the next iteration, once some may be evicted """
+        if self.roster is None or self.iteration_timeout is None:
+            return n_jobs
+        return sum(self.roster.values())
 
     def double_to_bytes(self, double):
         """ takes a double and returns
@@ -120,96 +331,312 @@ class Vegas_Socket(Generic_Socket):
         its byte representation so it can be sent
         via socket
         """
-        arr_len = len(double_array)
-        s = struct.pack('d'*arr_len, double_array)
-        return s
+        return array('d', double_array).tobytes()
 
     def read_partial_integral(self, size = 8, verbose = None):
-        """ Read the total integral from one of the jobs
-        and returns a double
+        """ Read the partial integral from one of the jobs
+        and returns it as an array of doubles
         """
-        data = self.receive_data(size, verbose = verbose)
-        double_array = []
-        for i in range(0, size-1, self.double_size):
-            double_array.append(self.bytes_to_double(data[i:i+8]))
-        return double_array
+        partial = array('d', bytes(size - size % self.double_size))
+        return self.receive_into(partial, verbose = verbose)
 
     def send_total_integral(self, total):
         """ Sends the total sum to a job
         """
-        data = []
-        for double in total:
-            data.append(self.double_to_bytes(double))
-        self.send_data(b''.join(data))
+        if not isinstance(total, array):
+            total = array('d', total)
+        self.send_data(total)
 
     def get_size(self):
         """ Gets the size of the data we are going to receive
         ie, gets an integer (size = 4 bytes)
         """
         data = self.receive_data(4)
-        try:
-            if data.decode() == "gree":
-                return -1
-            elif data.decode() == "bye!":
-                return -99 # Exit code
-        except:
-            pass
-        return int.from_bytes(data, byteorder="little")
+        return self.bytes_to_size(data)
 
     def harmonize_integral(self, n_jobs, verbose = None):
         """ Get the partial vegas integrals from the different n_jobs
         and send the sum back to each and every job.
         Only exits with success once all jobs receive their data
+        (or a quorum of them, once the iteration deadline has passed)
         """
         # Connect to the endpoint
         job_sockets = []
         array_partial = []
+        reported = Counter()
+        arrivals = []
+        start = time.monotonic()
+        deadline = None
+        self._waiting_for_quorum = False
+        self._waiting_for_shared = False
         while len(job_sockets) < n_jobs:
-            new_endpoint = self.wait_for_client()
+            remaining = self._remaining(deadline, reported, n_jobs)
+            if remaining == 0:
+                break
+            self.sock.settimeout(remaining)
+            try:
+                new_endpoint = self.wait_for_client()
+            except socket.timeout:
+                continue
+            new_endpoint.sock.settimeout(remaining)
 
             adr = self.get_host_by_address(str(new_endpoint.address[0]))
             prt = str(new_endpoint.address[1])
             self._info_print("   New endpoint connected: {0}:{1} [{2}/{3}]".format(adr, prt,len(job_sockets)+1,n_jobs))
+            new_endpoint.job = new_endpoint.address[0]
 
-            # Get the size of the array of doubles we are going to receive
-            size = new_endpoint.get_size()
-            if size == -1:
-                new_endpoint.send_data(b'die')
-                self._info_print(" > Killed orphan instance of nnlorun.py")
+            try:
+                # Get the size of the array of doubles we are going to receive
+                size = new_endpoint.get_size()
+                if size == -2:
+                    new_endpoint.job = new_endpoint.read_relay_name()
+                    size = new_endpoint.get_size()
+                if size == -1:
+                    new_endpoint.send_data(b'die')
+                    self._info_print(" > Killed orphan instance of nnlorun.py")
+                    continue
+                elif size == -99:
+                    self._info_print(" > nnlorun.py sent exit code, exiting with success")
+                    if self.upstream is not None:
+                        self.forward_exit()
+                    exit(0)
+                doubles = int(size / 8)
+                if verbose:
+                    self._info_print("Size of array: " + str(size))
+                    self._info_print("Meaning we will get " + str(doubles) + " doubles")
+
+                # Get the actual array of data
+                partial_value = new_endpoint.read_partial_integral(size, verbose = verbose)
+            except socket.timeout:
+                self._info_print(" > Dropped {0}:{1}, still sending at the deadline".format(adr, prt))
+                new_endpoint.close()
                 continue
-            elif size == -99:
-                self._info_print(" > nnlorun.py sent exit code, exiting with success")
-                exit(0)
-            doubles = int(size / 8)
-            if verbose:
-                self._info_print("Size of array: " + str(size))
-                self._info_print("Meaning we will get " + str(doubles) + " doubles")
-
-            # Get the actual array of data
-            partial_value = new_endpoint.read_partial_integral(size, verbose = verbose)
             if verbose:
                 self._info_print("Partial value obtained: " + str(partial_value))
-
+            admission = self._admit(new_endpoint, reported)
+            if admission != "accept":
+                self._turn_away(new_endpoint, admission, partial_value)
+                continue
 
             # Store the socket and the array we just received, we will use it in the future
             array_partial.append(partial_value)
             job_sockets.append(new_endpoint)
+            reported[new_endpoint.job] += 1
+            arrivals.append((adr, time.monotonic()-start))
+            if deadline is None and self.iteration_timeout is not None and self.roster is not None:
+                deadline = time.monotonic() + self.iteration_timeout
+        self.sock.settimeout(None)
 
-        integral_value = doubles*[0.0]
+        integral_value = array('d', bytes(doubles*self.double_size))
         for array_values in array_partial:
-            if len(array_values) != doubles:
-                raise Exception("Received arrays of different length!")
-            integral_value = list(map(lambda x,y: x+y, integral_value, array_values))
+            add_arrays(integral_value, array_values)
+        integral_value = self._close_iteration(n_jobs, reported, integral_value, arrivals)
 
+        if self.upstream is not None:
+            integral_value = self._forward_or_abandon(integral_value, job_sockets)
+        self.last_total = integral_value
         if verbose:
             self._info_print("Total value of the integral received: " + str(integral_value))
             self._info_print("Sending it back to all clients")
         while job_sockets:
             job_socket = job_sockets.pop()
+            job_socket.sock.settimeout(None)
             job_socket.send_total_integral(integral_value)
 
         return 0
 
+    def _read_partial(self, endpoint):
+        """ Reads whatever endpoint has available for the multiplexed server,
+        first the 4 byte size (after the name of the relay, for relays) and
+        then the array straight into endpoint.partial.
+        Returns True once the whole array has been received """
+        view = endpoint.view
+        nbytes = endpoint.sock.recv_into(view[endpoint.received:])
+        if nbytes == 0:
+            raise RuntimeError("socket connection broken")
+        endpoint.received += nbytes
+        if endpoint.received < len(view):
+            return False
+        endpoint.received = 0
+        if endpoint.stage == "partial":
+            return True
+        elif endpoint.stage == "name_size":
+            endpoint.stage = "name"
+            endpoint.view = memoryview(bytearray(int.from_bytes(view, byteorder="little")))
+            return False
+        elif endpoint.stage == "name":
+            endpoint.job = bytes(view).decode()
+            endpoint.stage = "size"
+            endpoint.view = memoryview(bytearray(4))
+            return False
+        endpoint.size = endpoint.bytes_to_size(bytes(view))
+        if endpoint.size == -2:
+            endpoint.stage = "name_size"
+            endpoint.view = memoryview(bytearray(4))
+            return False
+        if endpoint.size < 0:
+            return True
+        endpoint.partial = array('d', bytes(endpoint.size - endpoint.size % self.double_size))
+        endpoint.view = memoryview(endpoint.partial).cast('B')
+        endpoint.stage = "partial"
+        return len(endpoint.view) == 0
+
+    def read_relay_name(self):
+        """ Reads the name a relay sends after "rly!", see forward_upstream """
+        name_size = int.from_bytes(self.receive_data(4), byteorder="little")
+        return self.receive_data(name_size).decode()
+
+    def bytes_to_size(self, data):
+        """ Interprets the 4 bytes sent by a job before its array, see get_size """
+        try:
+            if data.decode() == "gree":
+                return -1
+            elif data.decode() == "bye!":
+                return -99 # Exit code
+            elif data.decode() == "rly!":
+                return -2 # Relay, its name comes next
+        except:
+            pass
+        return int.from_bytes(data, byteorder="little")
+
+    def harmonize_integral_multiplexed(self, n_jobs, verbose = None):
+        """ Same as harmonize_integral, but all jobs are accepted and read
+        at the same time with non-blocking sockets, adding up each partial
+        integral as soon as it is complete, and the total is then sent to
+        all jobs at once. An iteration takes as long as the slowest job,
+        rather than the sum of all of them (or as the deadline, if set).
+        """
+        selector = selectors.DefaultSelector()
+        self.sock.setblocking(False)
+        selector.register(self.sock, selectors.EVENT_READ)
+        accepting = True
+        connected = 0
+        job_sockets = []
+        integral_value = None
+        reported = Counter()
+        arrivals = []
+        start = time.monotonic()
+        deadline = None
+        self._waiting_for_quorum = False
+        self._waiting_for_shared = False
+
+        while len(job_sockets) < n_jobs:
+            remaining = self._remaining(deadline, reported, n_jobs)
+            if remaining == 0:
+                break
+            # Stop accepting once n_jobs are connected, as the blocking server does
+            if accepting and connected >= n_jobs:
+                selector.unregister(self.sock)
+                accepting = False
+            elif not accepting and connected < n_jobs:
+                selector.register(self.sock, selectors.EVENT_READ)
+                accepting = True
+
+            for key, events in selector.select(remaining):
+                if key.fileobj is self.sock:
+                    try:
+                        (client_socket, address) = self.sock.accept()
+                    except BlockingIOError:
+                        continue
+                    client_socket.setblocking(False)
+                    new_endpoint = self.__class__(client_socket, address)
+                    new_endpoint.view = memoryview(bytearray(4))
+                    new_endpoint.stage = "size"
+                    new_endpoint.received = 0
+                    new_endpoint.size = None
+                    new_endpoint.job = address[0]
+                    selector.register(client_socket, selectors.EVENT_READ, new_endpoint)
+                    connected += 1
+                    adr = self.get_host_by_address(str(address[0]))
+                    new_endpoint.hostname = adr
+                    self._info_print("   New endpoint connected: {0}:{1} [{2}/{3}]".format(adr, address[1], connected, n_jobs))
+                    continue
+
+                endpoint = key.data
+                try:
+                    complete = self._read_partial(endpoint)
+                except (RuntimeError, OSError) as e:
+                    self._info_print(" > Lost endpoint {0}:{1} ({2})".format(endpoint.address[0], endpoint.address[1], e))
+                    selector.unregister(endpoint.sock)
+                    endpoint.close()
+                    connected -= 1
+                    continue
+                if not complete:
+                    continue
+                selector.unregister(endpoint.sock)
+
+                if endpoint.size == -1:
+                    endpoint.sock.setblocking(True)
+                    endpoint.send_data(b'die')
+                    endpoint.close()
+                    connected -= 1
+                    self._info_print(" > Killed orphan instance of nnlorun.py")
+                    continue
+                elif endpoint.size == -99:
+                    self._info_print(" > nnlorun.py sent exit code, exiting with success")
+                    if self.upstream is not None:
+                        self.forward_exit()
+                    exit(0)
+
+                partial_value = endpoint.partial
+                if verbose:
+                    self._info_print("Partial value obtained: " + str(partial_value))
+                admission = self._admit(endpoint, reported)
+                if admission != "accept":
+                    self._turn_away(endpoint, admission, partial_value)
+                    connected -= 1
+                    continue
+                if integral_value is None:
+                    integral_value = partial_value
+                else:
+                    add_arrays(integral_value, partial_value)
+                job_sockets.append(endpoint)
+                reported[endpoint.job] += 1
+                arrivals.append((endpoint.hostname, time.monotonic()-start))
+                if deadline is None and self.iteration_timeout is not None and self.roster is not None:
+                    deadline = time.monotonic() + self.iteration_timeout
+
+        if accepting:
+            selector.unregister(self.sock)
+        self.sock.setblocking(True)
+        # Whoever is still sending at the deadline is left out
+        for key in list(selector.get_map().values()):
+            endpoint = key.data
+            self._info_print(" > Dropped {0}:{1}, still sending at the deadline".format(endpoint.address[0], endpoint.address[1]))
+            selector.unregister(endpoint.sock)
+            endpoint.close()
+        integral_value = self._close_iteration(n_jobs, reported, integral_value, arrivals)
+
+        if self.upstream is not None:
+            integral_value = self._forward_or_abandon(integral_value, job_sockets)
+        self.last_total = integral_value
+        if verbose:
+            self._info_print("Total value of the integral received: " + str(integral_value))
+            self._info_print("Sending it back to all clients")
+        total = memoryview(integral_value).cast('B')
+        pending = {}
+        for job_socket in job_sockets:
+            pending[job_socket.sock] = total
+            selector.register(job_socket.sock, selectors.EVENT_WRITE, job_socket)
+        while pending:
+            for key, events in selector.select():
+                job_socket = key.data
+                try:
+                    sent = job_socket.sock.send(pending[job_socket.sock])
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    self._info_print(" > Could not send total to {0}:{1} ({2})".format(job_socket.address[0], job_socket.address[1], e))
+                    sent = len(pending[job_socket.sock])
+                pending[job_socket.sock] = pending[job_socket.sock][sent:]
+                if len(pending[job_socket.sock]) == 0:
+                    del pending[job_socket.sock]
+                    selector.unregister(job_socket.sock)
+                    job_socket.close()
+        selector.close()
+
+        return 0
+
 def timeout_handler(signum, frame):
     raise Exception("The time has passed, it's time to run")
 
@@ -255,11 +682,31 @@ def parse_all_arguments():
     parser.add_argument("-N", "--N_clients", help = "Number of clients to wait for, if used alongside wait, stop waiting after N clients", default = "2")
     parser.add_argument("-m", "--manual", help = "Print the manual and exit", action = "store_true")
     parser.add_argument("-l", "--logfile", help = "Set the output logfile name (Stored in /tmp/<username>/socket_server/", default=None)
+    parser.add_argument("-B", "--buffer_size", help = "Size in bytes of the socket send/receive buffers. Default: let the OS tune them",
+                        type = int, default = None)
+    parser.add_argument("-R", "--relay", help = "Relay mode: sum up the jobs assigned by the server at <host:port> and forward them to it",
+                        default = None)
+    parser.add_argument("-M", "--mode", help = "Serve the clients of each iteration one at a time (blocking) or all at once (multiplexed)",
+                        choices = ["multiplexed", "blocking"], default = "multiplexed")
+    parser.add_argument("-T", "--timeout", help = "Seconds the jobs of an iteration have to report once the first one does. "
+                        "Default: wait for all of them", type = float, default = None)
+    parser.add_argument("-Q", "--quorum", help = "Fraction of the jobs needed to go ahead with an iteration after the timeout",
+                        type = float, default = 0.5)
+    parser.add_argument("--rescale", help = "Rescale the total of an iteration by the fraction of jobs missing. "
+                        "Assumes the partial integrals are sums over the events of each job", action = "store_true")
+    parser.add_argument("--evict", help = "Drop the jobs missing at the timeout from all later iterations. "
+                        "By default their late results are sent the last total and not added. Jobs sharing "
+                        "an IP can't be told apart, so they are always waited for", action = "store_true")
     args = parser.parse_args()
 
+    if not 0 < args.quorum <= 1:
+        parser.error("The quorum must be a fraction of the jobs")
+
     if args.wait:
         if "gridui" not in socket.gethostname():
             parser.error("Wait only to be used in gridui")
+        if args.relay:
+            parser.error("Relays get their jobs from the upstream server, wait can't be used with relay")
 
     if args.logfile is None:
         import datetime
@@ -278,8 +725,12 @@ def do_server(args,log):
     n_clients = int(args.N_clients)
 
     # enable the server, and bind it to HOST:PORT
-    server = Vegas_Socket(logger = log)
+    server = Vegas_Socket(logger = log, buffer_size = args.buffer_size)
     server.bind(HOST, PORT)
+    server.iteration_timeout = args.timeout
+    server.quorum = args.quorum
+    server.rescale = args.rescale
+    server.evict = args.evict
 
     if HOST == "":
         host_str = socket.gethostname()
@@ -288,6 +739,32 @@ def do_server(args,log):
 
     log.info("Server up. Connect to " + host_str + ":" + str(PORT))
 
+    #### If relay, this server sums up a group of the jobs and forwards it upstream
+    if args.relay:
+        upstream_host, upstream_port = args.relay.rsplit(":", 1)
+        server.upstream = (upstream_host, int(upstream_port))
+        # The upstream server tells us how many jobs have been sent our way
+        # once all of them have saluted it
+        log.info("Relaying to {0}. Waiting for it to assign jobs".format(args.relay))
+        # The upstream server may still be starting up
+        for attempt in range(RELAY_CONNECT_TRIES):
+            upstream = Vegas_Socket(logger = log)
+            try:
+                upstream.connect(*server.upstream)
+                break
+            except OSError as e:
+                upstream.close()
+                if attempt == RELAY_CONNECT_TRIES-1:
+                    raise
+                time.sleep(1)
+        server.relay_name = "{0}:{1}".format(host_str, PORT)
+        upstream.send_data("relay {0}".format(server.relay_name).encode())
+        n_clients = int(upstream.receive_str())
+        upstream.close()
+        if n_clients == 0:
+            log.info("No jobs assigned to this relay, exiting")
+            exit(0)
+
     #### If wait (this whole block is for its use with the grid scripts)
     if args.wait:
         # Wait for a number of ARC jobs to start before allowing the program to run
@@ -295,6 +772,7 @@ def do_server(args,log):
         # TODO: If we capture a rogue instance instead, skip to the while loop or make it fail? What should I do?
 
         clients = []
+        relays = []
 
         signal.signal(signal.SIGALRM, timeout_handler)
 
@@ -306,9 +784,6 @@ def do_server(args,log):
             try:
                 log.info("Waiting for {} more instances of nnlorun.py to salute".format(n_clients_max - n_clients))
                 new_client = server.wait_for_client()
-                if not clients: # Start the timer
-                    log.info("Starting timer for {0} secs".format(int(args.wait)))
-                    signal.alarm(int(args.wait))
             except:
                 break
             greetings = new_client.receive_str()
@@ -316,11 +791,19 @@ def do_server(args,log):
             if greetings == "greetings":
                 # nnlorun.py sends the word "greetins" at the start
                 #print("ARC.py captured")
+                if not clients: # Start the timer
+                    log.info("Starting timer for {0} secs".format(int(args.wait)))
+                    signal.alarm(int(args.wait))
                 clients.append(new_client)
             elif greetings == "oupsities":
                 n_clients_max -= 1
                 new_client.close()
                 continue
+            elif greetings.startswith("relay"):
+                # socket_server.py in relay mode, it doesn't count as a job
+                log.info("Relay {0} registered".format(greetings.split()[-1]))
+                relays.append((new_client, greetings.split()[-1]))
+                continue
             else:
                 log.info("Waiting for nnlorun.py instance, got nonsense instead.")
                 log.info("Received msg: {0}".format(greetings))
@@ -335,15 +818,41 @@ def do_server(args,log):
             log.critical("[WARNING] Something went wrong, no clients registered")
             exit(-1)
 
+        # Jobs are spread evenly over the relays, if there are any, and
+        # the relays become the clients of this server
+        roster = Counter(client.address[0] for client in clients)
+        relay_jobs = [0]*len(relays)
         for i in range(n_clients):
             socket_str = "-sockets {0} -ns {1}".format(n_clients, i+1)
+            if relays:
+                relay_jobs[i % len(relays)] += 1
+                socket_str += " -relay {0}".format(relays[i % len(relays)][1])
             client_out = clients.pop()
             client_out.send_data(socket_str.encode())
+        for (relay, relay_address), no_jobs in zip(relays, relay_jobs):
+            log.info("Relay {0}: {1} jobs".format(relay_address, no_jobs))
+            relay.send_data(str(no_jobs).encode())
+            relay.close()
+        if relays:
+            n_clients = len([no_jobs for no_jobs in relay_jobs if no_jobs > 0])
+            roster = Counter(relay_address for (_, relay_address), no_jobs in zip(relays, relay_jobs) if no_jobs > 0)
+        if args.timeout is not None:
+            server.roster = roster
     #### endif wait
 
     counter = 0
 
     log.info("Waiting for " + str(n_clients) + " clients")
+    if args.timeout is not None:
+        log.info("Iteration deadline: {0}s after the first job reports, quorum {1}, {2}, {3}".format(
+            args.timeout, args.quorum, "rescaling" if args.rescale else "not rescaling",
+            "evicting missing jobs" if args.evict else "keeping missing jobs"))
+        if server.roster is None:
+            log.info("Jobs not known yet, the first iteration waits for all of them")
+    if args.mode == "multiplexed":
+        harmonize_integral = server.harmonize_integral_multiplexed
+    else:
+        harmonize_integral = server.harmonize_integral
 
     start_time = datetime.datetime.now()
     # set a number of iterations
@@ -353,7 +862,8 @@ def do_server(args,log):
         # Wait for n_clients connections.
         # Once every client has sent its share of the data, sum it
         # together and send it back
-        success = server.harmonize_integral(n_clients, verbose = False)
+        success = harmonize_integral(n_clients, verbose = False)
+        n_clients = server.jobs_expected(n_clients)
         end_time = datetime.datetime.now()
         iteration_duration = end_time-start_time
         start_time = end_time
@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
+import asyncio
 import collections
 from datetime import datetime
+import gzip
+import hashlib
 import json
 import os
 import pyHepGrid.src.header as header
+import random
 import re
 import shutil
 import subprocess
+import sys
 from sys import version_info
 import tarfile
+import time
 from uuid import uuid4
+import zlib
 #
 # Misc. Utilities
 #
@@ -18,6 +25,105 @@ from uuid import uuid4
 MAX_COPY_TRIES = 10
 PROTOCOLS = ["srm", "gsiftp", "root", "xroot", "xrootd"]
 
+# Reasons for a failed transfer
+FAIL_TRANSFER = "transfer"   # The transfer command failed
+FAIL_MISSING = "missing"     # The remote file doesn't exist
+FAIL_TRUNCATED = "truncated" # The archive ended before it should
+FAIL_CORRUPT = "corrupt"     # The archive is not a valid gzipped tarfile
+FAIL_EMPTY = "empty"         # The archive has none of the expected files
+
+class RetryPolicy:
+    """ Exponential backoff with jitter between the attempts of an operation.
+    Only failures whose reason is in retry_on are tried again """
+    def __init__(self, max_attempts=MAX_COPY_TRIES, base_delay=1, max_delay=60,
+                 jitter=0.5, retry_on=(FAIL_TRANSFER, FAIL_TRUNCATED)):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_on = retry_on
+
+    def delay(self, attempt):
+        """ Seconds to wait after the failed attempt number attempt (from 0) """
+        delay = min(self.max_delay, self.base_delay*2**attempt)
+        return delay*(1 - self.jitter*random.random())
+
+    def should_retry(self, attempt, reason=FAIL_TRANSFER):
+        return attempt < self.max_attempts-1 and reason in self.retry_on
+
+    def wait(self, attempt):
+        time.sleep(self.delay(attempt))
+
+
+class ProtocolCache:
+    """ Recent gfal transfer results for each storage endpoint, stored as
+    {endpoint: {protocol: [[success, seconds], ...]}} in a local json file.
+    Used to try the protocol that has been working (and fastest) first """
+    def __init__(self, filename=None, window=None):
+        if filename is None:
+            filename = os.path.expanduser(header.protocol_cache)
+        if window is None:
+            window = header.protocol_cache_window
+        self.filename = filename
+        self.window = window
+        self.results = self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as cachefile:
+                return json.load(cachefile)
+        except (IOError, OSError, ValueError) as e:
+            return {}
+
+    @staticmethod
+    def endpoint(url):
+        """ Host of the storage element a gfal url points to """
+        match = re.match(r"^[a-z]+://([^/]+)", url)
+        if match is None:
+            return url
+        return match.group(1).split(":")[0]
+
+    def _score(self, results):
+        # Protocols not tried yet go between the working and the failing ones
+        if not results:
+            return (0.5, 0)
+        successes = [seconds for success, seconds in results if success]
+        rate = len(successes)/len(results)
+        latency = sum(successes)/len(successes) if successes else 0
+        return (rate, -latency)
+
+    def order(self, url, protocols=PROTOCOLS):
+        """ Protocols sorted by recent success rate at the endpoint of url,
+        then by average transfer time """
+        results = self.results.get(self.endpoint(url), {})
+        # sorted is stable, so ties keep the order given
+        return sorted(protocols, key=lambda protocol: self._score(results.get(protocol, [])),
+                      reverse=True)
+
+    def record(self, url, protocol, success, seconds):
+        """ Add the result of a transfer and save the cache. The file is read
+        again first so that results from other processes aren't lost """
+        self.results = self._load()
+        endpoint = self.results.setdefault(self.endpoint(url), {})
+        results = endpoint.setdefault(protocol, [])
+        results.append([bool(success), round(seconds, 3)])
+        del results[:-self.window]
+        tmpname = "{0}.{1}".format(self.filename, os.getpid())
+        try:
+            with open(tmpname, "w") as cachefile:
+                json.dump(self.results, cachefile)
+            os.replace(tmpname, self.filename)
+        except (IOError, OSError) as e:
+            header.logger.debug("Could not save protocol cache: {0}".format(e))
+
+
+def get_protocols(url=None):
+    """ Comma separated protocol preference for url, as passed to the
+    runfile on the worker nodes """
+    if url is None:
+        url = header.gfaldir
+    return ",".join(ProtocolCache().order(url))
+
 ###################################
 def pythonVersion():
     try:
@@ -68,6 +174,89 @@ def getOutputCall(cmd, suppress_errors = False):
         raise Exception("Something went wrong with Popen: ", ' '.join(cmd))
         return -1
 
+#
+# Asynchronous Subprocess Wrappers
+#
+CommandResult = collections.namedtuple("CommandResult",
+                                       ["cmd", "returncode", "stdout", "stderr", "attempts"])
+TIMEOUT_RETURNCODE = -9
+
+async def _run_command(cmd, semaphore, timeout, retry_policy):
+    """ Runs cmd once the semaphore allows it, killing it after timeout seconds
+    and trying again following retry_policy if it fails """
+    attempts = 0
+    while True:
+        attempts += 1
+        async with semaphore:
+            header.logger.debug(cmd)
+            try:
+                proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE,
+                                                            stderr=subprocess.PIPE)
+            except OSError as e:
+                # The command doesn't exist, no point in trying again
+                return CommandResult(cmd, -1, "", str(e), attempts)
+            try:
+                outbyt, errbyt = await asyncio.wait_for(proc.communicate(), timeout)
+                returncode = proc.returncode
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                outbyt, errbyt = b"", "Timed out after {0}s".format(timeout).encode()
+                returncode = TIMEOUT_RETURNCODE
+        if returncode == 0 or not retry_policy.should_retry(attempts-1):
+            return CommandResult(cmd, returncode, outbyt.decode("utf-8", "replace"),
+                                 errbyt.decode("utf-8", "replace"), attempts)
+        header.logger.debug("{0} failed with code {1}, retrying".format(" ".join(cmd), returncode))
+        await asyncio.sleep(retry_policy.delay(attempts-1))
+
+
+def run_commands(cmds, max_concurrent=None, timeout=None, retries=0, retry_delay=1,
+                 retry_policy=None):
+    """ Runs all commands in cmds concurrently from this process, with
+    at most max_concurrent of them at the same time. Each one is killed after
+    timeout seconds and retried up to retries times if it fails, with
+    exponential backoff starting at retry_delay (or following retry_policy).
+    Returns a CommandResult for each command, in the same order as cmds
+    """
+    if max_concurrent is None:
+        max_concurrent = header.max_concurrent_commands
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_attempts=retries+1, base_delay=retry_delay)
+    cmds = [[str(i) for i in cmd] for cmd in cmds]
+    if not cmds:
+        return []
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max(max_concurrent, 1))
+        return await asyncio.gather(*[_run_command(cmd, semaphore, timeout, retry_policy)
+                                      for cmd in cmds])
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run_all())
+    finally:
+        loop.close()
+
+
+def spCall_many(cmds, suppress_errors = False, **kwargs):
+    """ Concurrent version of spCall. The output of each command is printed
+    once it has finished. Returns the list of return codes """
+    results = run_commands(cmds, **kwargs)
+    if not suppress_errors:
+        for result in results:
+            print(result.stdout, end="")
+            print(result.stderr, end="", file=sys.stderr)
+    return [result.returncode for result in results]
+
+
+def getOutputCall_many(cmds, suppress_errors = False, **kwargs):
+    """ Concurrent version of getOutputCall. Returns the list of stdouts """
+    results = run_commands(cmds, **kwargs)
+    if not suppress_errors:
+        for result in results:
+            print(result.stderr, end="", file=sys.stderr)
+    return [result.stdout for result in results]
+
 #
 # Fileystem Wrappers
 #
@@ -85,6 +274,22 @@ def unique_filename():
     except:
         return unique_name
 
+def file_sha256(filename):
+    """ Hex sha256 digest of the contents of filename """
+    sha = hashlib.sha256()
+    with open(filename, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1<<20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_adler32(filename):
+    """ Adler32 checksum of the contents of filename, as printed by gfal-sum """
+    checksum = 1
+    with open(filename, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1<<20), b""):
+            checksum = zlib.adler32(chunk, checksum)
+    return "{0:08x}".format(checksum & 0xffffffff)
+
 def checkIfThere(dirPath, file):
     if not os.path.exists(os.path.join(dirPath, file)):
         return False
@@ -191,11 +396,14 @@ def lhapdfIni():
     tar_w.tarDir(lhapdf, lhapdf_gridname)
     size = os.path.getsize(lhapdf_gridname)/float(1<<20)
     header.logger.info("> LHAPDF tar size: {0:>6.3f} MB".format(size))
-    if grid_w.checkForThis(lhapdf_gridname, lhapdf_griddir):
-        header.logger.info("> Removing previous version of lhapdf in the grid")
-        grid_w.delete(lhapdf_gridname, lhapdf_griddir)
-    header.logger.info("> Sending new lhapdf to grid as {0}".format(lhapdf_gridname))
-    grid_w.send(lhapdf_gridname, lhapdf_griddir)
+    if grid_w.is_unchanged(lhapdf_gridname, lhapdf_griddir):
+        header.logger.info("> lhapdf in the grid is already up to date")
+    else:
+        if grid_w.checkForThis(lhapdf_gridname, lhapdf_griddir):
+            header.logger.info("> Removing previous version of lhapdf in the grid")
+            grid_w.delete(lhapdf_gridname, lhapdf_griddir)
+        header.logger.info("> Sending new lhapdf to grid as {0}".format(lhapdf_gridname))
+        grid_w.send(lhapdf_gridname, lhapdf_griddir)
     shutil.rmtree(lhapdf)
     os.remove(lhapdf_gridname)
 
@@ -204,15 +412,45 @@ def lhapdfIni():
 #
 
 class TarWrap:
+    """ In deterministic mode (header.deterministic_tars by default) the same
+    inputs always give the same bytes: members are sorted, ownership and
+    times are dropped and the gzip header carries no name or timestamp """
+
+    def __init__(self, deterministic=None):
+        if deterministic is None:
+            deterministic = header.deterministic_tars
+        self.deterministic = deterministic
+
+    @staticmethod
+    def _normalise(tarinfo):
+        tarinfo.mtime = 0
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ""
+        # Keep whether the file is executable, but not the umask it was made with
+        if tarinfo.isdir() or tarinfo.mode & 0o111:
+            tarinfo.mode = 0o755
+        else:
+            tarinfo.mode = 0o644
+        return tarinfo
+
+    def _write(self, inputList, output_name):
+        if not self.deterministic:
+            with tarfile.open(output_name, "w:gz") as output_tar:
+                for infile in inputList:
+                    output_tar.add(infile)
+            return
+        # Directories are added in sorted order by tarfile itself
+        with open(output_name, "wb") as rawfile, \
+             gzip.GzipFile(filename="", mode="wb", fileobj=rawfile, mtime=0) as gzfile, \
+             tarfile.open(fileobj=gzfile, mode="w", format=tarfile.GNU_FORMAT) as output_tar:
+            for infile in sorted(inputList):
+                output_tar.add(infile, filter=self._normalise)
 
     def tarDir(self, inputDir, output_name):
-        with tarfile.open(output_name, "w:gz") as output_tar:
-            output_tar.add(inputDir)
+        self._write([inputDir], output_name)
 
     def tarFiles(self, inputList, output_name):
-        with tarfile.open(output_name, "w:gz") as output_tar:
-            for infile in inputList:
-                output_tar.add(infile)
+        self._write(inputList, output_name)
 
     def listFilesTar(self, tarred_file):
         with tarfile.open(tarred_file, 'r|gz') as tfile:
@@ -266,11 +504,62 @@ class TarWrap:
 #
 # GridUtilities
 #
+# Contents of the grid directories listed so far, {gridname: (time listed, [filenames])}.
+# Shared by all GridWraps, kept up to date by send and delete and listed
+# again after header.grid_listing_ttl seconds
+_grid_listings = {}
+
 class GridWrap:
     # Defaults
     # Need to refactor post dpm gfal
 
-    def send(self, tarfile, whereTo, shell=False):
+    @staticmethod
+    def _dir_gridname(directory):
+        return os.path.join(header.gfaldir, directory).rstrip("/")
+
+    def _listing(self, directory):
+        """ Names of the files in directory. gfal-ls is only called if the
+        last listing is older than header.grid_listing_ttl, failed listings
+        are not remembered """
+        gridname = self._dir_gridname(directory)
+        listed, names = _grid_listings.get(gridname, (None, None))
+        if listed is None or time.monotonic() - listed > header.grid_listing_ttl:
+            cmd = ["gfal-ls", gridname]
+            header.logger.debug(cmd)
+            listing = subprocess.run(cmd, stdout=subprocess.PIPE)
+            names = listing.stdout.decode("utf-8").split()
+            if listing.returncode != 0:
+                _grid_listings.pop(gridname, None)
+                return names
+            _grid_listings[gridname] = (time.monotonic(), names)
+        return names
+
+    def _listing_add(self, filename, directory):
+        listed, names = _grid_listings.get(self._dir_gridname(directory), (None, None))
+        if names is not None and filename not in names:
+            names.append(filename)
+
+    def _listing_remove(self, filename, directory):
+        listed, names = _grid_listings.get(self._dir_gridname(directory), (None, None))
+        if names is not None and filename in names:
+            names.remove(filename)
+
+    def _stat(self, filename, where):
+        """ Checks with the storage itself (not the cached listing) whether
+        filename is in where """
+        cmd = ["gfal-stat", os.path.join(header.gfaldir, where, filename)]
+        header.logger.debug(cmd)
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL).returncode == 0
+
+    def invalidate(self, directory):
+        """ Forget the listing of directory, so it is listed again next time """
+        _grid_listings.pop(self._dir_gridname(directory), None)
+
+    def send(self, tarfile, whereTo, shell=False, interactive=True):
+        """ Copies tarfile to whereTo. After 3 failed attempts asks whether
+        to keep trying, or gives up if not interactive (eg. when sending from
+        several threads at once). Returns 0 once tarfile is on the storage """
         what = ["file:///{0}/".format(os.getcwd()) + tarfile]
         gridname = os.path.join(header.gfaldir, whereTo, tarfile)
         cmd = ["gfal-copy", what[0], gridname]
@@ -279,19 +568,19 @@ class GridWrap:
         while True:
             success = spCall(cmd, shell=shell)
             # Check whether we actually sent what we wanted to send
-            if self.checkForThis(tarfile, whereTo):
-                break
-            elif count < 3: # 3 attempts before asking for input...
+            if self._stat(tarfile, whereTo):
+                self._listing_add(tarfile, whereTo)
+                return 0
+            self._listing_remove(tarfile, whereTo)
+            if count < 3: # 3 attempts before asking for input...
                 header.logger.warning("{0} could not be copied to the grid storage /for some reason/ after {1} attempt(s)".format(tarfile,count))
                 header.logger.info("Automatically trying again...")
             else:
                 header.logger.warning("{0} could not be copied to the grid storage /for some reason/ after {1} attempt(s)".format(tarfile,count))
-                yn = input(" Try again? (y/n) ")
-                if not yn.startswith("y"):
+                if not interactive or not input(" Try again? (y/n) ").startswith("y"):
                     header.logger.error("{0} was not copied to the grid storage after {1} attempt(s)".format(tarfile,count))
-                    break
+                    return success or 1
             count +=1
-        return success
 
     def bring(self, tarfile, whereFrom, whereTo, shell=False, timeout = None, suppress_errors=False):
         gridname = os.path.join(header.gfaldir, whereFrom, tarfile)
@@ -299,50 +588,101 @@ class GridWrap:
         success = gfal_copy(gridname, destpath)
         return os.path.isfile(whereTo)
 
+    def bring_many(self, tarfiles, whereFrom, whereTo, timeout = None):
+        """ Brings all tarfiles from whereFrom to the local paths in whereTo
+        with concurrent gfal-copy calls. Files which couldn't be copied are
+        tried again through all protocols with gfal_copy.
+        Returns the list of tarfiles which have been brought """
+        gridnames = [os.path.join(header.gfaldir, whereFrom, tarfile) for tarfile in tarfiles]
+        destpaths = ["file://{0}".format(os.path.abspath(local)) for local in whereTo]
+        cmds = [["gfal-copy", "-f", gridname, destpath]
+                for gridname, destpath in zip(gridnames, destpaths)]
+        run_commands(cmds, timeout=timeout, retries=2)
+        brought = []
+        for tarfile, gridname, destpath, local in zip(tarfiles, gridnames, destpaths, whereTo):
+            if not os.path.isfile(local):
+                gfal_copy(gridname, destpath)
+            if os.path.isfile(local):
+                brought.append(tarfile)
+        return brought
+
     def delete(self, tarfile, whereFrom):
         gridname = os.path.join(header.gfaldir, whereFrom, tarfile)
         cmd = ["gfal-rm", gridname]
-        return spCall(cmd)
+        retval = spCall(cmd)
+        if retval == 0:
+            self._listing_remove(tarfile, whereFrom)
+        else:
+            self.invalidate(whereFrom)
+        return retval
+
+    def delete_many(self, tarfiles, whereFrom):
+        """ Deletes all tarfiles from whereFrom with concurrent gfal-rm calls """
+        cmds = [["gfal-rm", os.path.join(header.gfaldir, whereFrom, tarfile)]
+                for tarfile in tarfiles]
+        retvals = spCall_many(cmds)
+        self.invalidate(whereFrom)
+        return retvals
 
     def checkForThis(self, filename, where):
-        gridname = os.path.join(header.gfaldir, where)
-        cmd = ["gfal-ls", gridname]
-        output = getOutputCall(cmd)
-        if filename in output:
-            return True
-        else:
+        return filename in self._listing(where)
+
+    def get_checksum(self, filename, where):
+        """ Adler32 checksum of filename in the grid storage, None if it
+        couldn't be obtained """
+        gridname = os.path.join(header.gfaldir, where, filename)
+        cmd = ["gfal-sum", gridname, "ADLER32"]
+        header.logger.debug(cmd)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output = result.stdout.decode("utf-8").split()
+        if result.returncode != 0 or not output:
+            return None
+        return output[-1].lower().zfill(8)
+
+    def is_unchanged(self, filename, where):
+        """ Whether the local file filename is identical (same adler32) to the
+        one already in where """
+        if not self.checkForThis(filename, where):
             return False
+        remote = self.get_checksum(filename, where)
+        return remote is not None and remote == file_adler32(filename)
 
     def get_dir_contents(self, directory):
-        gridname = os.path.join(header.gfaldir, directory)
-        cmd = ["gfal-ls", gridname]
-        output = getOutputCall(cmd)
-        return output
+        return "\n".join(self._listing(directory))
 
     def delete_directory(self, directory):
         # Get contents and delete them one by one (there is no recursive for this that I could find)
         files = self.get_dir_contents(directory).split()
-        for filename in files:
-            self.delete(filename, directory)
+        self.delete_many(files, directory)
         return spCall(self.delete_dir + [directory])
 
 
 def gfal_copy(infile, outfile, maxrange=MAX_COPY_TRIES):
     header.logger.info("Copying {0} to {1}".format(infile, outfile))
     protoc = header.gfaldir.split(":")[0]
-    for protocol in PROTOCOLS: # cycle through available protocols until one works.
-        infile_tmp = infile.replace(protoc, protocol)
-        outfile_tmp = outfile.replace(protoc, protocol)
-        header.logger.debug("Attempting Protocol {0}".format(protocol))
-        for i in range(maxrange): # try max 10 times for now ;)
+    policy = RetryPolicy(max_attempts=maxrange)
+    cache = ProtocolCache()
+    # The storage end of the copy is whichever isn't local
+    remote = outfile if infile.startswith("file:") else infile
+    protocols = cache.order(remote)
+    for i in range(maxrange): # try max 10 times for now ;)
+        for protocol in protocols: # cycle through available protocols until one works.
+            infile_tmp = infile.replace(protoc, protocol)
+            outfile_tmp = outfile.replace(protoc, protocol)
+            header.logger.debug("Attempting Protocol {0}".format(protocol))
             cmd = "gfal-copy {0} {1}".format(infile_tmp, outfile_tmp)
             header.logger.debug(cmd)
+            start = time.time()
             retval = os.system(cmd)
+            cache.record(remote, protocol, retval == 0, time.time()-start)
             if retval == 0:
                 return retval
         # if copying to the grid and it has failed, remove before trying again
             if retval != 0 and "file" not in outfile:
                 os.system("gfal-rm {0}".format(outfile_tmp))
+        # Back off before going through all protocols again
+        if policy.should_retry(i):
+            policy.wait(i)
     header.logger.error("Copy failed.")
     return 9999999
 